@@ -0,0 +1,88 @@
+import gc
+import json
+import random
+import sys
+import tempfile
+import tracemalloc
+
+import main
+
+
+# Compares what a synthetic group costs in memory as the nested dicts loaded from the JSON files
+# and as the compact record types in main.py, built from the JSON and mapped from a published scale.snap:
+#   python bench_memory.py [users] [days]
+# The mapped snapshot's rows live in the page cache, tracemalloc only sees the records that point into them.
+
+
+def make_scale(users, days, start=1600000000.0):
+    scale = {'strategy': '1'}
+    for user_id in range(users):
+        weight = random.uniform(60, 120)
+        records = []
+        for day in range(days):
+            weight += random.uniform(-0.4, 0.3)
+            records.append([str(start + day * 86400 + random.uniform(0, 3600)), round(weight, 2)])
+        scale[str(100000000 + user_id)] = {'height': round(random.uniform(1.5, 1.95), 2), 'weight': records}
+    return scale
+
+
+def make_ckpts(scale, count, start=1600000000.0):
+    ckpts = {}
+    for n in range(count):
+        result = {}
+        for user_id, scale_data in scale.items():
+            if not user_id.isdigit():
+                continue
+            result[user_id] = scale_data['weight'][min(n * 7, len(scale_data['weight']) - 1)] if random.random() < 0.9 else None
+        ckpts[str(n + 1)] = {'start': start + n * 7 * 86400, 'end': start + n * 7 * 86400 + 6 * 3600, 'result': result,
+                             'status': 'active', 'calculated': True}
+    return ckpts
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def bench(users, days):
+    random.seed(0)
+    scale_text = json.dumps(make_scale(users, days))
+    ckpt_text = json.dumps(make_ckpts(json.loads(scale_text), 4))
+    events = [(1600000000.0 + i * 3600, 'alarm' if i % 3 else 'result', './data/-1001/1', str(i % 4 + 1)) for i in range(users)]
+
+    rows = []
+    scale, dict_size = measure(lambda: json.loads(scale_text))
+    challengers, record_size = measure(lambda: {user_id: main._Challenger.from_json(user_id, scale_data)
+                                                for user_id, scale_data in json.loads(scale_text).items() if user_id.isdigit()})
+    rows.append(('challengers', dict_size, record_size))
+    scale_path = tempfile.mkdtemp(prefix='bench-memory-')
+    main._publish_snapshot(scale, scale_path)
+    snapshot, record_size = measure(lambda: main._map_scale_snapshot(scale_path))
+    rows.append(('scale.snap', dict_size, record_size))
+    ckpts, dict_size = measure(lambda: json.loads(ckpt_text))
+    checkpoints, record_size = measure(lambda: {n: main._Checkpoint.from_json(ckpt) for n, ckpt in json.loads(ckpt_text).items()})
+    rows.append(('checkpoints', dict_size, record_size))
+    _, dict_size = measure(lambda: [{'due': due, 'kind': kind, 'path': path, 'n': n} for due, kind, path, n in events])
+    _, record_size = measure(lambda: [main._CkptEvent(due, kind, path, n) for due, kind, path, n in events])
+    rows.append(('ckpt jobs', dict_size, record_size))
+
+    # the record types must serialize back to the shape the JSON files already have
+    expected = {user_id: scale_data for user_id, scale_data in scale.items() if user_id.isdigit()}
+    assert {user_id: challenger.to_json() for user_id, challenger in challengers.items()} == expected
+    assert {user_id: challenger.to_json() for user_id, challenger in snapshot['challengers'].items()} == expected
+    assert {n: checkpoint.to_json() for n, checkpoint in checkpoints.items()} == ckpts
+
+    print(f'{users} users, {days} days of weigh-ins')
+    print(f'{"":12} {"dicts":>12} {"records":>12} {"saved":>7}')
+    for name, dict_size, record_size in rows:
+        print(f'{name:12} {dict_size / 2 ** 20:10.2f}MB {record_size / 2 ** 20:10.2f}MB {1 - record_size / dict_size:7.1%}')
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 60)
@@ -0,0 +1,67 @@
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+# Renders the default /plot with matplotlib and with the Pillow fast path, each in its own process:
+#   python bench_plot.py [renders] [users] [days]
+# Reports the import time of main, the first and the mean render time, and how much the process grew
+# from before the import to the last render: matplotlib is only imported by the renderer that uses it.
+
+
+def make_users_data(main, users, days, start=1600000000.0):
+    random.seed(0)
+    users_data = []
+    for user in range(users):
+        weight = random.uniform(60, 110)
+        records = np.zeros(days, dtype=main.snapshot_record_dtype)
+        for day in range(days):
+            weight += random.uniform(-0.4, 0.3)
+            records[day] = (start + day * 86400 + random.uniform(0, 3600), round(weight, 1))
+        users_data.append({'username': f'user{user}', 'weight': records})
+    return users_data
+
+
+def run(renderer, renders, users, days):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    import main
+    imported = time.perf_counter() - start
+    render = main._render_plot_fast if renderer == 'pillow' else main._render_plot_matplotlib
+    users_data = make_users_data(main, users, days)
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-plot-'), 'plot.png')
+    durations = []
+    for _ in range(renders):
+        start = time.perf_counter()
+        render(users_data, f'user0 in last {days} days', path)
+        durations.append(time.perf_counter() - start)
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print(f'{renderer} {imported} {durations[0]} {sum(durations[1:]) / max(len(durations) - 1, 1)} {grown} {os.path.getsize(path)}')
+
+
+def bench(renders, users, days):
+    print(f'{renders} renders of {users} user(s) over {days} days')
+    print(f'{"":12} {"import ms":>9} {"first ms":>9} {"mean ms":>9} {"rss +MB":>9} {"png KB":>8}')
+    rows = {}
+    for renderer in ['matplotlib', 'pillow']:
+        output = subprocess.run([sys.executable, __file__, '--run', renderer, str(renders), str(users), str(days)],
+                                capture_output=True, text=True, check=True).stdout.split()
+        imported, first, mean, grown, size = float(output[1]), float(output[2]), float(output[3]), int(output[4]), int(output[5])
+        rows[renderer] = mean
+        print(f'{renderer:12} {imported * 1000:9.1f} {first * 1000:9.1f} {mean * 1000:9.1f} {grown / 1024:9.1f} {size / 1024:8.1f}')
+    print(f'pillow is {rows["matplotlib"] / rows["pillow"]:.1f}x faster per plot')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        import main
+        sizes = [int(i) for i in sys.argv[1:]]
+        bench(*(sizes + [50, 1, main.plot_default_days][len(sizes):]))
@@ -1,17 +1,51 @@
+import cProfile
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
 import json
 import logging
+import logging.handlers
 import math
+import mmap
 import os
+import pickle
+import pstats
+import queue
+import random
+import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
+import urllib.parse
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from math import sqrt
 
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 import numpy as np
 import telegram
-from telegram.ext import Updater, CommandHandler
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, TypeHandler, ExtBot
+from telegram.utils.request import Request
+from telegram.utils.helpers import escape_markdown
+from telegram.vendor.ptb_urllib3 import urllib3
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
 
 help_text = """欢迎使用本 bot，请使用如下命令：
 /w 或者 /weight 添加体重记录（只记录当天最后一条）
@@ -20,6 +54,7 @@ help_text = """欢迎使用本 bot，请使用如下命令：
 /week 查看本周排名
 /overall 查看总排名
 /plot 查看指定天数和其他用户（支持 all）的的体重变化图
+/me 查看自己的打卡天数、体重统计、移动平均和 BMI 趋势
 /new_challenge 在本群开展减肥挑战 admin only
 /end_challenge 结束本群的挑战 admin only
 /delete_user 删除用户数据 admin only
@@ -30,13 +65,70 @@ help_text = """欢迎使用本 bot，请使用如下命令：
 /ckpt_list 查看所有检查点
 /ckpt_result 检查点结果
 /ckpt_overall 检查点完成情况
+/forecast 按最近的体重趋势预测下一检查点（或指定编号）的通过情况
+/dashboard 查看本群挑战的统计总览图
+/league 查看本群所在联赛的跨群排名，/league join 联赛名 加入或创建联赛，/league leave 退出联赛 admin only
+/import 回复 CSV 或体重秤导出文件，导入历史体重数据（可指定 @用户）admin only
+/profile 分析指定命令接下来 N 次调用的耗时（可指定群组 id）operator only
 """
 
 start_help = """欢迎使用减肥群 bot，请将本 bot 拉入超级群组中开启减肥挑战。
 使用 /help 可以查看所有命令。"""
 
+log_path = 'bot.log'
+log_max_bytes = 20 * 1024 * 1024
+log_backup_count = 10
+log_fields = ['group_id', 'command', 'duration']
+log_sample_rate = 0.05
+
+# nothing is run_async on the dispatcher pool any more, slow commands go to the lanes below
+bot_workers = 2
+# commands not listed run inline on the dispatcher thread, in order: writes and quick replies.
+# /import is slow but rewrites scale.json, off the dispatcher it could lose a /w that lands meanwhile
+command_lanes = {
+    'rank': 'read', 'week': 'read', 'overall': 'read', 'ckpt_list': 'read', 'league': 'read', 'forecast': 'read',
+    'plot': 'heavy', 'ckpt_result': 'heavy', 'ckpt_overall': 'heavy', 'dashboard': 'heavy',
+}
+# queue counts running and waiting requests of the lane, group and user cap them per chat and per sender
+lane_limits = {
+    'read': {'workers': 4, 'queue': 32, 'group': 4, 'user': 2},
+    'heavy': {'workers': 2, 'queue': 8, 'group': 2, 'user': 1},
+}
+http_connect_timeout = 5.0
+http_read_timeout = 10.0
+http2_enabled = os.environ.get('SCALE_BOT_HTTP2') == '1'
+# point these at a stub server, e.g. http://127.0.0.1:8081/bot, to run without Telegram
+api_base_url = os.environ.get('SCALE_BOT_API_URL')
+api_base_file_url = os.environ.get('SCALE_BOT_API_FILE_URL')
+api_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf]
+api_latency_report_interval = 600
+# read-only JSON API for internal dashboards, e.g. 127.0.0.1:8080, off when unset
+http_api_address = os.environ.get('SCALE_BOT_HTTP_API')
+http_api_cache_size = 1000
+# appends every incoming command with hashed ids to this file for replay.py, off when unset
+record_path = os.environ.get('SCALE_BOT_RECORD')
+# user ids allowed to use /profile, comma separated
+profile_operators = [i.strip() for i in os.environ.get('SCALE_BOT_OPERATORS', '').split(',') if i.strip()]
+profile_default_calls = 5
+profile_top = 40
+
 challenges_path = './data/challenges.json'
+leagues_path = './data/leagues.json'
 job_path = './data/job'
+update_state_path = f'{job_path}/updates.json'
+update_state_interval = 10
+# caches and pending checkpoint events handed from one run to the next, bump the format when their shape changes
+warm_state_path = f'{job_path}/warm.pickle'
+warm_state_magic = b'SPWS'
+warm_state_format = 4
+catch_up_commands = ['w', 'weight']
+json_generations = 3
+json_checksum_prefix = '#sha256:'
+
+snapshot_magic = b'SPBS'
+snapshot_header_dtype = np.dtype([('magic', 'S4'), ('strategy', '<u4'), ('generation', '<u8'), ('users', '<u8'), ('records', '<u8')])
+snapshot_user_dtype = np.dtype([('user_id', '<i8'), ('height', '<f8'), ('offset', '<u8'), ('count', '<u8')])
+snapshot_record_dtype = np.dtype([('timestamp', '<f8'), ('weight', '<f8')])
 
 metrics = {
     '1': {'name': '体重变化', 'expression': '原体重-现体重', 'key': lambda x: (x['weight'][0][1] - x['weight'][-1][1])},
@@ -46,11 +138,389 @@ metrics = {
                                          x['original_weight'] - 21 * x['height'] ** 2)},
 }
 
-queueing_job = {}
+# the same strategies over whole columns: first weight, last weight and height of every challenger
+vector_metrics = {
+    '1': lambda first, last, height: first - last,
+    '2': lambda first, last, height: (first - last) / first,
+    '3': lambda first, last, height: np.copysign((first - last) / np.sqrt(np.abs(first - 21 * height ** 2)), first - 21 * height ** 2),
+}
+
+bmi_bins = [0, 18.5, 24, 28, np.inf]
+bmi_labels = ['underweight', 'normal', 'overweight', 'obese']
+
+import_date_columns = ['date', 'time', 'timestamp', 'datetime', 'measurementtime', 'timeofmeasurement', 'measuredat', '日期', '时间', '测量时间', '记录时间']
+import_weight_columns = ['weight', '体重']
+import_time_formats = [
+    '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d',
+    '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d',
+    '%Y.%m.%d %H:%M:%S', '%Y.%m.%d %H:%M', '%Y.%m.%d',
+    '%Y年%m月%d日 %H:%M:%S', '%Y年%m月%d日 %H:%M', '%Y年%m月%d日',
+]
+
+ckpt_live_status = ['pending', 'running', 'ended']
+ckpt_alarm_ahead = timedelta(hours=12)
+ckpt_forecast_ahead = timedelta(days=1)
+# trend fit behind /forecast: recency weighted least squares over the window, reweighted with Tukey's biweight
+forecast_window = timedelta(days=14)
+forecast_half_life = 7
+forecast_min_points = 3
+forecast_iterations = 3
+forecast_tukey = 4.685
+forecast_min_scale = 0.2
+forecast_digest_limit = 20
+ckpt_tick_slack = 1
+ckpt_workers = 4
+announce_rate = 20
+announce_chat_gap = 1
+announce_jitter = 2
+member_cache_ttl = 3600
+member_cache_size = 20000
+plot_default_days = 14
+# the last weigh-ins kept in every user's aggregate, enough for the 30-day average at one entry per day
+weight_agg_recent = 30
+# plots with at most this many users are drawn with Pillow, the rest with matplotlib
+plot_fast_users = 3
+plot_size = (768, 576)
+plot_colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+plot_max_date_labels = 15
+anomaly_scan_time = datetime.strptime('03:30', '%H:%M').time()
+anomaly_lookback = timedelta(days=1)
+anomaly_window = 3
+anomaly_threshold = 4
+anomaly_min_mad = 0.5
+anomaly_chunk = 1 << 18
+anomaly_digest_limit = 20
+page_size = 20
+league_top = 100
+league_name_pattern = re.compile(r'^\w{1,32}$')
+page_cache_size = 1000
+precompute_enabled = True
+precompute_delay = 5
+precompute_ttl = 3600
+precompute_cpu_budget = 0.2
+precompute_window = 60
+
+dashboard_cache = {}
+challenge_registry = {}
+legacy_challenges = {}
+leagues = {}
+league_lock = threading.Lock()
+league_boards = {}
+scale_snapshots = {}
+ckpt_cache = {}
+weight_aggs = {}
+flight_lock = threading.Lock()
+flight_calls = {}
+flight_memo = {}
+flight_memo_ttl = 15
+flight_stats = {'computed': 0, 'coalesced': 0, 'hit': 0}
+log_context = threading.local()
+api_latency_lock = threading.Lock()
+api_latency = {}
+member_lock = threading.Lock()
+member_cache = OrderedDict()
+update_state = {'update_id': 0, 'saved': 0}
+record_lock = threading.Lock()
+record_file = {}
+profile_lock = threading.Lock()
+profile_run_lock = threading.Lock()
+profile_commands = set()
+profile_sessions = {}
+page_lock = threading.Lock()
+page_cache = OrderedDict()
+http_api_lock = threading.Lock()
+http_api_cache = OrderedDict()
+plot_lock = threading.Lock()
+plot_cache = {}
+plot_fonts = {}
+precompute_lock = threading.Lock()
+precompute_run_lock = threading.Lock()
+precompute_pending = {}
+precompute_stop = threading.Event()
+precompute_cpu = []
+ckpt_lock = threading.Lock()
+ckpt_heaps = {}
+ckpt_due_heap = []
+ckpt_timer = {}
+ckpt_event_seq = itertools.count()
+ckpt_settle_locks = {}
+ckpt_pool = ThreadPoolExecutor(max_workers=ckpt_workers, thread_name_prefix='ckpt')
+announce_queue = queue.Queue()
+announce_worker = {}
+lane_lock = threading.Lock()
+lanes = {name: {'pool': ThreadPoolExecutor(max_workers=limit['workers'], thread_name_prefix=name), 'total': 0, 'groups': {}, 'users': {}, 'keys': set(),
+                'rejected': 0} for name, limit in lane_limits.items()}
+ckpt_metrics = {'ticks': 0, 'groups': 0, 'events': 0, 'sent': 0, 'lag_last': 0.0, 'lag_max': 0.0}
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        for field in log_fields:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _log_context_filter(record):
+    # runs on the thread that logged, before the record is handed over to the listener thread
+    for field in log_fields:
+        if not hasattr(record, field):
+            setattr(record, field, getattr(log_context, field, None))
+    return True
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _setup_logging():
+    file_handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=log_max_bytes, backupCount=log_backup_count, encoding='utf-8')
+    file_handler.namer = lambda name: f'{name}.gz'
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(_JsonFormatter())
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(_log_context_filter)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _set_log_context(group_id=None, command=None):
+    log_context.group_id = group_id
+    log_context.command = command
+
+
+def _log_sampled(msg):
+    if random.random() < log_sample_rate:
+        logging.info(msg)
+
+
+def _command(command, func):
+    profile_commands.add(command)
+
+    def wrapper(update, context):
+        _set_log_context(str(update.effective_chat.id) if update.effective_chat else None, command)
+        start_time = time.perf_counter()
+        try:
+            session = profile_sessions.get(command)
+            if session is not None and session['group_id'] in (None, log_context.group_id):
+                return _run_profiled(command, session, func, update, context)
+            return func(update, context)
+        finally:
+            logging.info(f'{command} done', extra={'duration': round(time.perf_counter() - start_time, 4)})
+            _set_log_context()
+
+    return wrapper
+
+
+def _run_profiled(command, session, func, update, context):
+    # cProfile only follows the calling thread, and two profilers must not be active at once: a call that would have
+    # to wait for another profiled one runs unprofiled instead, nothing on the dispatcher waits behind a profiler
+    if not profile_run_lock.acquire(blocking=False):
+        return func(update, context)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, update, context)
+    finally:
+        profile_run_lock.release()
+        stats = pstats.Stats(profiler)
+        finished = False
+        with profile_lock:
+            # a session stopped by /profile meanwhile has been sent already
+            if profile_sessions.get(command) is session:
+                if session['stats'] is None:
+                    session['stats'] = stats
+                else:
+                    session['stats'].add(stats)
+                session['calls'] += 1
+                if session['calls'] >= session['limit']:
+                    del profile_sessions[command]
+                    finished = True
+        if finished:
+            _send_profile(context.bot, command, session)
+
+
+def _send_profile(bot, command, session):
+    if session['stats'] is None:
+        bot.send_message(chat_id=session['chat_id'], text=f'/{command} 的性能分析已结束，没有收集到调用')
+        return
+    output = io.StringIO()
+    session['stats'].stream = output
+    session['stats'].sort_stats('cumulative').print_stats(profile_top)
+    where = f' gid={session["group_id"]}' if session['group_id'] else ''
+    bot.send_document(chat_id=session['chat_id'], document=io.BytesIO(output.getvalue().encode()),
+                      filename=f'profile_{command}.txt', caption=f'/{command}{where} {session["calls"]} 次调用的累计耗时前 {profile_top} 项')
+
+
+def _add_command(dp, command, func):
+    handler = _command(command, func)
+    lane = command_lanes.get(command)
+    dp.add_handler(CommandHandler(command, _lane(lane, handler) if lane else handler))
+
+
+def _lane(lane, handler):
+    def submit(update, context):
+        group_id = str(update.effective_chat.id)
+        # channel posts have no sender, the chat itself is held to the per-user cap then
+        user_id = str(update.effective_user.id) if update.effective_user is not None else group_id
+        # the same command with the same arguments from the same person in the same chat
+        key = (group_id, user_id, update.effective_message.text)
+        with lane_lock:
+            state = lanes[lane]
+            limit = lane_limits[lane]
+            if key in state['keys']:
+                busy = '上一条相同的请求还在处理中，请稍候'
+            elif state['users'].get(user_id, 0) >= limit['user']:
+                busy = '你还有请求正在处理中，请稍后再试'
+            elif state['total'] >= limit['queue'] or state['groups'].get(group_id, 0) >= limit['group']:
+                busy = 'bot 现在有点忙，请稍后再试'
+            else:
+                busy = None
+                state['keys'].add(key)
+                state['total'] += 1
+                state['groups'][group_id] = state['groups'].get(group_id, 0) + 1
+                state['users'][user_id] = state['users'].get(user_id, 0) + 1
+            if busy is not None:
+                state['rejected'] += 1
+        if busy is not None:
+            logging.info(f'{lane} lane busy gid={group_id} uid={user_id} running={state["total"]} rejected={state["rejected"]}')
+            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=update.effective_message.message_id, text=busy)
+            return
+        state['pool'].submit(_lane_run, state, handler, update, context, key)
+
+    return submit
+
+
+def _lane_run(state, handler, update, context, key):
+    group_id, user_id, _ = key
+    try:
+        handler(update, context)
+    except:
+        logging.exception(f"ERROR lane gid={group_id} uid={user_id}")
+    finally:
+        with lane_lock:
+            state['keys'].discard(key)
+            state['total'] -= 1
+            for counts, name in [(state['groups'], group_id), (state['users'], user_id)]:
+                counts[name] -= 1
+                if counts[name] == 0:
+                    del counts[name]
+
+
+class _Http2Pool:
+    # quacks like the urllib3 pool Request._request_wrapper expects, so its error mapping is reused as is
+    def __init__(self, pool_size, connect_timeout, read_timeout):
+        self._client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=120),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    def request(self, method, url, fields=None, body=None, headers=None, timeout=None):
+        kwargs = {'headers': headers}
+        if timeout is not None:
+            kwargs['timeout'] = httpx.Timeout(timeout.read_timeout, connect=timeout.connect_timeout)
+        if fields is not None:
+            kwargs['data'] = {i: j for i, j in fields.items() if not isinstance(j, tuple)}
+            kwargs['files'] = {i: j for i, j in fields.items() if isinstance(j, tuple)}
+        else:
+            kwargs['content'] = body
+        try:
+            resp = self._client.request(method, url, **kwargs)
+        except httpx.TimeoutException as error:
+            raise urllib3.exceptions.TimeoutError(str(error)) from error
+        except httpx.HTTPError as error:
+            raise urllib3.exceptions.HTTPError(str(error)) from error
+        resp.status = resp.status_code
+        resp.data = resp.content
+        return resp
+
+    def clear(self):
+        self._client.close()
+
+
+class _TimedRequest(Request):
+    def __init__(self, http2=False, **kwargs):
+        super().__init__(**kwargs)
+        if http2:
+            self._con_pool = _Http2Pool(kwargs['con_pool_size'], kwargs['connect_timeout'], kwargs['read_timeout'])
+
+    def post(self, url, data, timeout=None):
+        start_time = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        finally:
+            _record_api_latency(url.rsplit('/', 1)[-1], time.perf_counter() - start_time)
+
+    def retrieve(self, url, timeout=None):
+        start_time = time.perf_counter()
+        try:
+            return super().retrieve(url, timeout=timeout)
+        finally:
+            _record_api_latency('download', time.perf_counter() - start_time)
+
+
+def _record_api_latency(method, seconds):
+    with api_latency_lock:
+        if method not in api_latency:
+            api_latency[method] = [0] * len(api_latency_buckets)
+        for i, bucket in enumerate(api_latency_buckets):
+            if seconds <= bucket:
+                api_latency[method][i] += 1
+                break
+
+
+def _format_api_latency():
+    with api_latency_lock:
+        lines = []
+        for method, counts in sorted(api_latency.items()):
+            histogram = ' '.join(f'<={bucket}s:{count}' for bucket, count in zip(api_latency_buckets, counts) if count)
+            lines.append(f'{method} n={sum(counts)} {histogram}')
+    return '\n'.join(lines)
+
+
+def _report_api_latency(context):
+    logging.info(f'api latency\n{_format_api_latency()}')
+    # the per-announcement log line is sampled, this one is not
+    logging.info(f'announce queued={announce_queue.qsize()} sent={ckpt_metrics["sent"]} lag_last={ckpt_metrics["lag_last"]:.2f}s '
+                 f'lag_max={ckpt_metrics["lag_max"]:.2f}s')
+    with flight_lock:
+        stats = dict(flight_stats)
+    logging.info(f'single flight computed={stats["computed"]} coalesced={stats["coalesced"]} hit={stats["hit"]}')
+
+
+def _make_bot(bot_token):
+    # every dispatcher and lane worker, the updater, job queue, checkpoint pool and announce/precompute threads can hold a connection
+    pool_size = bot_workers + sum(limit['workers'] for limit in lane_limits.values()) + ckpt_workers + 6
+    request = _TimedRequest(
+        http2=http2_enabled and httpx is not None, con_pool_size=pool_size,
+        connect_timeout=http_connect_timeout, read_timeout=http_read_timeout)
+    return ExtBot(bot_token, base_url=api_base_url, base_file_url=api_base_file_url, request=request)
+
+
+class _Clock:
+    # every "what time is it" in the bot goes through here, simulate.py swaps in a virtual one
+    def now(self):
+        return datetime.now()
+
+    def timestamp(self):
+        return self.now().timestamp()
+
+
+clock = _Clock()
 
 
 def _get_timestamp():
-    return str(datetime.now().timestamp())
+    return str(clock.timestamp())
 
 
 def _get_timestr(timestamp, format='%Y-%m-%d %H:%M:%S'):
@@ -60,20 +530,38 @@ def _get_timestr(timestamp, format='%Y-%m-%d %H:%M:%S'):
 
 def _is_today(timestamp):
     record = datetime.fromtimestamp(float(timestamp))
-    today = datetime.now()
+    today = clock.now()
     return record.year == today.year and record.month == today.month and record.day == today.day
 
 
+def _get_member(bot, group_id, user_id):
+    key = (str(group_id), str(user_id))
+    with member_lock:
+        cached = member_cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                member_cache.move_to_end(key)
+                return cached[1]
+            del member_cache[key]
+    user = bot.get_chat_member(group_id, user_id).to_dict()['user']
+    with member_lock:
+        member_cache[key] = (time.monotonic() + member_cache_ttl, user)
+        member_cache.move_to_end(key)
+        while len(member_cache) > member_cache_size:
+            member_cache.popitem(last=False)
+    return user
+
+
 def _get_username(bot, group_id, user_id):
     try:
-        return bot.get_chat_member(group_id, user_id).to_dict()['user']['username']
+        return _get_member(bot, group_id, user_id)['username']
     except:
         return user_id
 
 
 def _get_fullname(bot, group_id, user_id):
     try:
-        user = bot.get_chat_member(group_id, user_id).to_dict()['user']
+        user = _get_member(bot, group_id, user_id)
     except:
         return str(user_id)
     if 'last_name' in user:
@@ -90,28 +578,134 @@ def _get_info(update):
     return group_id, user_id, username, message_id
 
 
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _dump_json(obj, path):
+    data = json.dumps(obj)
+    checksum = hashlib.sha256(data.encode()).hexdigest()
+    dir_path = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(f'{data}\n{json_checksum_prefix}{checksum}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        if os.path.exists(path):
+            for generation in range(json_generations - 1, 0, -1):
+                if os.path.exists(f'{path}.{generation}'):
+                    os.replace(f'{path}.{generation}', f'{path}.{generation + 1}')
+            try:
+                os.link(path, f'{path}.1')
+            except OSError:
+                shutil.copy2(path, f'{path}.1')
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(dir_path)
+
+
+def _read_checked_json(path):
+    try:
+        text = open(path, "r").read()
+    except FileNotFoundError:
+        return None
+    body, sep, trailer = text.rstrip('\n').rpartition('\n')
+    if sep and trailer.startswith(json_checksum_prefix):
+        if hashlib.sha256(body.encode()).hexdigest() != trailer[len(json_checksum_prefix):]:
+            return None
+        text = body
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def _read_json(path):
+    # like _load_json, but never writes: None when neither the file nor a backup exists
+    candidates = [path] + [f'{path}.{generation}' for generation in range(1, json_generations + 1)]
+    for candidate in candidates:
+        obj = _read_checked_json(candidate)
+        if obj is not None:
+            if candidate != path:
+                logging.warning(f'{path} is damaged, recovered from {candidate}')
+            return obj
+    if any(os.path.exists(candidate) for candidate in candidates):
+        raise ValueError(f'{path} and all of its backups are damaged')
+    return None
+
+
+def _load_json(path, default):
+    obj = _read_json(path)
+    if obj is None:
+        _dump_json(default, path)
+        return default
+    return obj
+
+
 def _get_challenges():
-    if not os.path.exists(challenges_path):
-        json.dump({}, open(challenges_path, "w"))
-    return json.load(open(challenges_path, "r"))
+    # the old global registry, only read to migrate groups into their own registry.json
+    if 'challenges' not in legacy_challenges:
+        legacy_challenges['challenges'] = _read_checked_json(challenges_path) or {}
+    return legacy_challenges['challenges']
+
+
+def _get_group_registry(group_id):
+    if group_id in challenge_registry:
+        return challenge_registry[group_id]
+    registry_path = f'./data/{group_id}/registry.json'
+    if os.path.exists(registry_path) or os.path.exists(f'{registry_path}.1'):
+        entry = _load_json(registry_path, {}) or None
+    else:
+        entry = _get_challenges().get(group_id)
+        if entry is not None:
+            _set_group_registry(group_id, entry)
+    challenge_registry[group_id] = entry
+    return entry
+
+
+def _set_group_registry(group_id, entry):
+    _ensure_path(f'./data/{group_id}')
+    _dump_json(entry, f'./data/{group_id}/registry.json')
+    challenge_registry[group_id] = entry
+
+
+def _iter_group_registry():
+    group_ids = set(_get_challenges())
+    for group_id in os.listdir('./data'):
+        if os.path.exists(f'./data/{group_id}/registry.json'):
+            group_ids.add(group_id)
+    for group_id in group_ids:
+        entry = _get_group_registry(group_id)
+        if entry is not None:
+            yield group_id, entry
 
 
 def _get_challenge(group_path, update):
     group_id, user_id, username, message_id = _get_info(update)
-    challenge_path = f'{group_path}/challenge.json'
-    if not os.path.exists(challenge_path):
-        tmp = {
-            'group_id': group_id,
-            'challenges': {}
-        }
-        json.dump(tmp, open(challenge_path, "w"))
-    return json.load(open(challenge_path, "r"))
+    tmp = {
+        'group_id': group_id,
+        'challenges': {}
+    }
+    return _load_json(f'{group_path}/challenge.json', tmp)
 
 
 def _get_latest_challenge(update):
     group_id, user_id, username, message_id = _get_info(update)
-    challenges = _get_challenges()
-    challenge_cnt = str(challenges[group_id]['challenge_cnt'])
+    challenge_cnt = str(_get_group_registry(group_id)['challenge_cnt'])
     group_path = f'./data/{group_id}'
     _ensure_path(group_path)
     challenge = _get_challenge(group_path, update)
@@ -120,18 +714,161 @@ def _get_latest_challenge(update):
 
 def _get_scale(challenge_cnt_path):
     _ensure_path(challenge_cnt_path)
-    scale_path = f'{challenge_cnt_path}/scale.json'
-    if not os.path.exists(scale_path):
-        json.dump({}, open(scale_path, "w"))
-    return json.load(open(scale_path, "r"))
+    return _load_json(f'{challenge_cnt_path}/scale.json', {})
+
+
+def _read_snapshot_generation(snap_path):
+    try:
+        header = np.fromfile(snap_path, dtype=snapshot_header_dtype, count=1)
+    except (FileNotFoundError, ValueError):
+        return 0
+    if len(header) == 0 or header[0]['magic'] != snapshot_magic:
+        return 0
+    return int(header[0]['generation'])
+
+
+def _publish_snapshot(scale, scale_path):
+    snap_path = f'{scale_path}/scale.snap'
+    challengers = [_Challenger.from_json(user_id, scale_data) for user_id, scale_data in scale.items() if user_id.isdigit()]
+    users = np.zeros(len(challengers), dtype=snapshot_user_dtype)
+    offset = 0
+    for i, challenger in enumerate(challengers):
+        users[i] = (int(challenger.user_id), np.nan if challenger.height is None else challenger.height, offset, len(challenger.series))
+        offset += len(challenger.series)
+    records = np.concatenate([challenger.series.records for challenger in challengers] or [np.zeros(0, dtype=snapshot_record_dtype)])
+    header = np.zeros(1, dtype=snapshot_header_dtype)
+    header[0] = (snapshot_magic, int(scale.get('strategy', 0)), _read_snapshot_generation(snap_path) + 1, len(users), len(records))
+
+    fd, tmp_path = tempfile.mkstemp(dir=scale_path, prefix='.scale.snap.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(users.tobytes())
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, snap_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _save_scale(scale, scale_path):
+    users = {user_id: _update_weight_agg(scale_data) for user_id, scale_data in scale.items() if user_id.isdigit()}
+    _dump_json(scale, f'{scale_path}/scale.json')
+    _publish_snapshot(scale, scale_path)
+    weight_aggs[scale_path] = {'version': _get_data_version(f'{scale_path}/scale.json'), 'users': users}
+
+
+def _update_weight_agg(scale_data):
+    # 'agg' covers every weigh-in but the last one, which weight_ may still replace today, and is folded in once a later one arrives
+    weights = scale_data.get('weight', [])
+    closed = max(len(weights) - 1, 0)
+    agg = scale_data.get('agg')
+    if agg is None or agg['count'] > closed or (agg['count'] and weights[agg['count'] - 1][0] != agg['last']):
+        # first write since the aggregates exist, or the history was rewritten underneath them (import, catch-up)
+        agg = {'count': 0, 'mean': 0.0, 'm2': 0.0, 'min': None, 'max': None, 'last': None, 'day': None, 'streak': 0, 'best': 0, 'recent': []}
+    for data_timestamp, weight_data in weights[agg['count']:closed]:
+        _fold_weight_agg(agg, data_timestamp, weight_data)
+    scale_data['agg'] = agg
+    return {'agg': agg, 'pending': weights[-1] if weights else None, 'height': scale_data.get('height')}
+
+
+def _fold_weight_agg(agg, data_timestamp, weight_data):
+    agg['count'] += 1
+    delta = weight_data - agg['mean']
+    agg['mean'] += delta / agg['count']
+    agg['m2'] += delta * (weight_data - agg['mean'])
+    agg['min'] = weight_data if agg['min'] is None else min(agg['min'], weight_data)
+    agg['max'] = weight_data if agg['max'] is None else max(agg['max'], weight_data)
+    agg['last'] = data_timestamp
+    day = datetime.fromtimestamp(float(data_timestamp)).toordinal()
+    if agg['day'] is None or day > agg['day'] + 1:
+        agg['streak'] = 1
+    elif day == agg['day'] + 1:
+        agg['streak'] += 1
+    agg['day'] = max(day, agg['day'] or day)
+    agg['best'] = max(agg['best'], agg['streak'])
+    agg['recent'].append([float(data_timestamp), weight_data])
+    del agg['recent'][:-weight_agg_recent]
+
+
+def _get_scale_snapshot(scale_path):
+    snap_path = f'{scale_path}/scale.snap'
+    json_version = _get_data_version(f'{scale_path}/scale.json')[0]
+    snap_version = _get_data_version(snap_path)[0]
+    if snap_version is None or (json_version is not None and json_version[0] > snap_version[0]):
+        # no snapshot yet, or scale.json was written by something that does not publish one
+        _publish_snapshot(_get_scale(scale_path), scale_path)
+    return _map_scale_snapshot(scale_path)
+
+
+def _map_scale_snapshot(scale_path):
+    snap_path = f'{scale_path}/scale.snap'
+    stat = os.stat(snap_path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = scale_snapshots.get(scale_path)
+    if cached is not None and cached['key'] == key:
+        return cached
+
+    with open(snap_path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = np.frombuffer(buffer, dtype=snapshot_header_dtype, count=1)[0]
+    users = np.frombuffer(buffer, dtype=snapshot_user_dtype, count=int(header['users']), offset=snapshot_header_dtype.itemsize)
+    records = np.frombuffer(buffer, dtype=snapshot_record_dtype, count=int(header['records']),
+                            offset=snapshot_header_dtype.itemsize + users.nbytes)
+    snapshot = {
+        'key': key,
+        'generation': int(header['generation']),
+        'strategy': str(header['strategy']) if header['strategy'] else None,
+        'users': users,
+        'records': records,
+        'challengers': {str(user_id): _Challenger(str(user_id), None if np.isnan(height) else height, _WeightSeries(records[offset:offset + count]))
+                        for user_id, height, offset, count in users.tolist()},
+    }
+    scale_snapshots[scale_path] = snapshot
+    return snapshot
 
 
 def _get_ckpt(ckpt_cnt_path):
     _ensure_path(ckpt_cnt_path)
-    ckpt_path = f'{ckpt_cnt_path}/ckpt.json'
-    if not os.path.exists(ckpt_path):
-        json.dump({}, open(ckpt_path, "w"))
-    return json.load(open(ckpt_path, "r"))
+    ckpt_json_path = f'{ckpt_cnt_path}/ckpt.json'
+    version = _get_data_version(ckpt_json_path)
+    cached = ckpt_cache.get(ckpt_cnt_path)
+    if cached is None or cached[0] != version:
+        cached = (version, _ckpts_from_json(_load_json(ckpt_json_path, {})))
+        ckpt_cache[ckpt_cnt_path] = cached
+    return _copy_ckpts(cached[1])
+
+
+def _dump_ckpt(ckpts, ckpt_cnt_path):
+    ckpt_json_path = f'{ckpt_cnt_path}/ckpt.json'
+    obj = dict(ckpts)
+    if 'ckpt' in obj:
+        obj['ckpt'] = {ckpt_n: ckpt.to_json() for ckpt_n, ckpt in obj['ckpt'].items()}
+    try:
+        _dump_json(obj, ckpt_json_path)
+    except:
+        # the records were changed in place, the next read has to go back to the file
+        ckpt_cache.pop(ckpt_cnt_path, None)
+        raise
+    ckpt_cache[ckpt_cnt_path] = (_get_data_version(ckpt_json_path), _copy_ckpts(ckpts))
+
+
+def _ckpts_from_json(ckpts):
+    if 'ckpt' in ckpts:
+        ckpts['ckpt'] = {ckpt_n: _Checkpoint.from_json(ckpt) for ckpt_n, ckpt in ckpts['ckpt'].items()}
+    return ckpts
+
+
+def _copy_ckpts(ckpts):
+    # the records are shared, the dicts around them are not: adding a checkpoint does not change what another request iterates
+    ckpts = dict(ckpts)
+    if 'ckpt' in ckpts:
+        ckpts['ckpt'] = dict(ckpts['ckpt'])
+    return ckpts
 
 
 def _ensure_ckpt(update):
@@ -149,17 +886,136 @@ def _ensure_ckpt(update):
 def _get_running_jobs():
     _ensure_path(job_path)
     running_job_path = f'{job_path}/running.json'
-    if not os.path.exists(running_job_path):
-        json.dump({}, open(running_job_path, "w"))
-    return json.load(open(running_job_path, "r")), running_job_path
+    return _load_json(running_job_path, {}), running_job_path
 
 
 def _get_done_jobs():
     _ensure_path(job_path)
     done_job_path = f'{job_path}/done.json'
-    if not os.path.exists(done_job_path):
-        json.dump({}, open(done_job_path, "w"))
-    return json.load(open(done_job_path, "r")), done_job_path
+    return _load_json(done_job_path, {}), done_job_path
+
+
+class _WeightSeries:
+    # a challenger's weigh-ins as snapshot_record_dtype rows, a view into the mapped scale.snap when read from a snapshot
+    __slots__ = ('records',)
+
+    def __init__(self, records=None):
+        self.records = np.zeros(0, dtype=snapshot_record_dtype) if records is None else records
+
+    @classmethod
+    def from_json(cls, weights):
+        return cls(np.array([(float(timestamp), weight) for timestamp, weight in weights], dtype=snapshot_record_dtype))
+
+    def to_json(self):
+        return [[str(timestamp), weight] for timestamp, weight in self.records.tolist()]
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    @property
+    def weights(self):
+        return self.records['weight']
+
+    def first_between(self, start, end):
+        inside = np.flatnonzero((self.timestamps > start) & (self.timestamps < end))
+        return int(inside[0]) if len(inside) else None
+
+
+class _Challenger:
+    __slots__ = ('user_id', 'height', 'series', 'extra')
+
+    def __init__(self, user_id, height=None, series=None, extra=None):
+        self.user_id = user_id
+        self.height = height
+        self.series = series if series is not None else _WeightSeries()
+        self.extra = extra
+
+    @classmethod
+    def from_json(cls, user_id, scale_data):
+        extra = {key: value for key, value in scale_data.items() if key not in ('height', 'weight')}
+        return cls(user_id, scale_data.get('height'), _WeightSeries.from_json(scale_data['weight']), extra or None)
+
+    def to_json(self):
+        scale_data = dict(self.extra or {})
+        if self.height is not None:
+            scale_data['height'] = self.height
+        scale_data['weight'] = self.series.to_json()
+        return scale_data
+
+
+class _Checkpoint:
+    # result is kept column-wise, a missing reading is a NaN timestamp
+    __slots__ = ('start', 'end', 'status', 'calculated', 'users', 'timestamps', 'weights', 'extra')
+
+    def __init__(self, start, end, status='active', calculated=None, extra=None):
+        self.start = float(start)
+        self.end = float(end)
+        self.status = status
+        self.calculated = calculated
+        self.users = array('q')
+        self.timestamps = array('d')
+        self.weights = array('d')
+        self.extra = extra
+
+    @classmethod
+    def from_json(cls, ckpt):
+        extra = {key: value for key, value in ckpt.items() if key not in ('start', 'end', 'status', 'calculated', 'result')}
+        checkpoint = cls(ckpt['start'], ckpt['end'], ckpt['status'], ckpt.get('calculated'), extra or None)
+        for user_id, record in ckpt.get('result', {}).items():
+            checkpoint.users.append(int(user_id))
+            checkpoint.timestamps.append(float(record[0]) if record else math.nan)
+            checkpoint.weights.append(record[1] if record else math.nan)
+        return checkpoint
+
+    def to_json(self):
+        ckpt = dict(self.extra or {})
+        ckpt.update({'start': self.start, 'end': self.end, 'result': dict(self.result_items()), 'status': self.status})
+        if self.calculated is not None:
+            ckpt['calculated'] = self.calculated
+        return ckpt
+
+    def result_items(self):
+        for user_id, timestamp, weight in zip(self.users, self.timestamps, self.weights):
+            yield str(user_id), None if math.isnan(timestamp) else [str(timestamp), weight]
+
+    def set_results(self, readings):
+        # readings maps a user id to (timestamp, weight) or None, a user without one keeps what is in already
+        # and is only reported missing when there is nothing
+        rows = {user_id: i for i, user_id in enumerate(self.users)}
+        missing = []
+        for user_id, reading in readings.items():
+            i = rows.get(int(user_id))
+            if reading is None and i is not None:
+                continue
+            timestamp, weight = (math.nan, math.nan) if reading is None else reading
+            if i is None:
+                self.users.append(int(user_id))
+                self.timestamps.append(timestamp)
+                self.weights.append(weight)
+            else:
+                self.timestamps[i] = timestamp
+                self.weights[i] = weight
+            if reading is None:
+                missing.append(user_id)
+        return missing
+
+
+class _CkptEvent:
+    __slots__ = ('due', 'seq', 'kind', 'ckpt_path', 'ckpt_n')
+
+    def __init__(self, due, kind, ckpt_path, ckpt_n):
+        self.due = due
+        self.seq = next(ckpt_event_seq)
+        self.kind = kind
+        self.ckpt_path = ckpt_path
+        self.ckpt_n = ckpt_n
+
+    def __lt__(self, other):
+        return (self.due, self.seq) < (other.due, other.seq)
 
 
 def _parse_input_datetime(inputs):
@@ -184,12 +1040,120 @@ def _parse_input_datetime_pair(inputs):
         return None
 
 
+def _parse_import_time(inputs):
+    inputs = inputs.strip()
+    try:
+        timestamp = float(inputs)
+        # exports in milliseconds
+        return timestamp / 1000 if timestamp > 1e11 else timestamp
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(inputs).timestamp()
+    except ValueError:
+        pass
+    for time_format in import_time_formats:
+        try:
+            return datetime.strptime(inputs, time_format).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_import_weight(inputs, unit_scale):
+    found = re.search(r'\d+(\.\d+)?', inputs.replace(',', '.'))
+    if found is None:
+        return None
+    return float(found.group()) * unit_scale
+
+
+def _find_import_columns(header):
+    date_col, weight_col, unit_scale = None, None, 1.0
+    for i, name in enumerate(header):
+        name = re.sub(r'[\s"\'_]', '', name.lower())
+        if date_col is None and re.sub(r'[(（].*', '', name) in import_date_columns:
+            date_col = i
+        elif weight_col is None and any(name.startswith(j) for j in import_weight_columns):
+            weight_col = i
+            if 'lb' in name:
+                unit_scale = 0.45359237
+            elif '斤' in name and '公斤' not in name:
+                unit_scale = 0.5
+    return date_col, weight_col, unit_scale
+
+
+def _parse_weight_export(content):
+    for encoding in ['utf-8-sig', 'gbk']:
+        try:
+            text = content.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        return None, 0
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    rows = [row for row in csv.reader(io.StringIO(text), dialect) if any(i.strip() for i in row)]
+    if len(rows) == 0:
+        return None, 0
+
+    date_col, weight_col, unit_scale = _find_import_columns(rows[0])
+    if date_col is not None and weight_col is not None:
+        rows = rows[1:]
+    elif _parse_import_time(rows[0][0]) is not None:
+        date_col, weight_col, unit_scale = 0, 1, 1.0
+    else:
+        return None, 0
+
+    now = clock.timestamp()
+    records = {}
+    skipped = 0
+    for row in rows:
+        try:
+            timestamp = _parse_import_time(row[date_col])
+            weight_data = _parse_import_weight(row[weight_col], unit_scale)
+        except IndexError:
+            timestamp, weight_data = None, None
+        if timestamp is None or weight_data is None or weight_data < 40 or weight_data > 400 or timestamp > now:
+            skipped += 1
+            continue
+        weight_data = round(weight_data, 2)
+        day = datetime.fromtimestamp(timestamp).date()
+        if day not in records or records[day][0] <= timestamp:
+            records[day] = (timestamp, weight_data)
+    records = [[str(timestamp), weight_data] for timestamp, weight_data in sorted(records.values())]
+    return records, skipped
+
+
+def _merge_weight_records(weights, records):
+    merged = []
+    for record in heapq.merge(weights, records, key=lambda x: float(x[0])):
+        if len(merged) > 0 and datetime.fromtimestamp(float(merged[-1][0])).date() == datetime.fromtimestamp(float(record[0])).date():
+            merged.pop(-1)
+        merged.append(list(record))
+    return merged
+
+
+def _import_weight_records(scale, user_id, records):
+    if user_id not in scale:
+        scale[user_id] = {'weight': []}
+    before = len(scale[user_id]['weight'])
+    scale[user_id]['weight'] = _merge_weight_records(scale[user_id]['weight'], records)
+    return len(scale[user_id]['weight']) - before
+
+
+def _get_scale_path(update):
+    group_id, user_id, username, message_id = _get_info(update)
+    challenge, challenge_cnt = _get_latest_challenge(update)
+    return f'./data/{group_id}/{challenge_cnt}'
+
+
 def _get_userid(update, context, usernames, all_flag):
-    scale, scale_path = _ensure_scale(update)
+    snapshot = _get_scale_snapshot(_get_scale_path(update))
     ret = {}
-    for userid in scale:
-        if not userid.isdigit():
-            continue
+    for userid in snapshot['challengers']:
         username = _get_username(context.bot, update.effective_chat.id, userid)
         if username in usernames or all_flag:
             ret[username] = userid
@@ -254,6 +1218,17 @@ def _ensure_path(path):
         os.makedirs(path)
 
 
+def _get_data_version(*paths):
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
 def _calc_bmi(weight_scale, height_scale):
     return weight_scale / height_scale ** 2
 
@@ -262,69 +1237,215 @@ def _running_challenge_only(update, context):
     if not (_supergroup_only(update, context)):
         return False
     group_id, user_id, username, message_id = _get_info(update)
-    challenges = _get_challenges()
-    if group_id in challenges:
-        if challenges[group_id]['status'] == 'ended':
+    registry = _get_group_registry(group_id)
+    if registry is not None:
+        if registry['status'] == 'ended':
             context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='没有正在进行的挑战')
             return False
-    if group_id not in challenges:
+    if registry is None:
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'没有正在进行的挑战')
         return False
     return True
 
 
-def _get_scale_data(update, context, time_limit, users=None):
-    group_id, user_id, username, message_id = _get_info(update)
-    scale, scale_path = _ensure_scale(update)
-    if 'strategy' not in scale:
-        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请先使用 /strategy 指定比赛策略。')
-        return
-    strategy_id = scale['strategy']
-    compare = metrics[strategy_id]['key']
+def _collect_scale_data(bot, group_id, snapshot, time_limit, users=None, warn=None, strategy=None):
+    compare = metrics[strategy or snapshot['strategy']]['key']
+    limit = -np.inf if time_limit == datetime.min else time_limit.timestamp()
     user_data = []
-    for user_id, data in scale.items():
+    for user_id, challenger in snapshot['challengers'].items():
         if users and user_id not in users.values():
             continue
-        if not user_id.isdigit():
+        username = _get_username(bot, group_id, user_id)
+        fullname = _get_fullname(bot, group_id, user_id)
+        records = challenger.series.records
+        if challenger.height is None:
+            if warn:
+                warn(f'@{username} 没有添加过身高数据')
             continue
-        username = _get_username(context.bot, group_id, user_id)
-        fullname = _get_fullname(context.bot, group_id, user_id)
-        if 'height' not in data:
-            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 没有添加过身高数据')
+        if len(records) == 0:
+            if warn:
+                warn(f'@{username} 没有添加过体重数据')
             continue
-        if len(data['weight']) == 0:
-            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 没有添加过体重数据')
+        first = int(np.searchsorted(records['timestamp'], limit, side='left'))
+        if first == len(records):
+            if warn:
+                warn(f'@{username} 在限定时间内没有添加体重数据')
             continue
-        ret = {'fullname': fullname, 'username': username, 'height': data['height'], 'original_weight': data['weight'][0][1], 'weight': []}
-        for data_timestamp, weight_data in data['weight'][::-1]:
-            data_time = datetime.fromtimestamp(float(data_timestamp))
-            if data_time >= time_limit:
-                ret['weight'].append([data_timestamp, weight_data])
-            else:
-                if len(ret['weight']) == 0:
-                    context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 在限定时间内没有添加体重数据')
-                    break
-                last_time = datetime.fromtimestamp(float(ret['weight'][-1][0]))
-                if abs(data_time - time_limit) > abs(last_time - time_limit):
-                    ret['weight'].append([data_timestamp, weight_data])
-                break
-        if len(ret['weight']) != 0:
-            ret['weight'] = ret['weight'][::-1]
-            ret['score'] = compare(ret)
-            user_data.append(ret)
+        if first > 0 and limit - records['timestamp'][first - 1] > records['timestamp'][first] - limit:
+            first -= 1
+        ret = {'user_id': user_id, 'fullname': fullname, 'username': username, 'height': challenger.height, 'original_weight': records['weight'][0],
+               'weight': records[first:]}
+        ret['score'] = compare(ret)
+        user_data.append(ret)
     return user_data
 
 
-def _rank(update, context, time_limit):
+def _get_scale_data(update, context, time_limit, users=None):
     group_id, user_id, username, message_id = _get_info(update)
-    user_data = _get_scale_data(update, context, time_limit)
-    if user_data is None:
+    snapshot = _get_scale_snapshot(_get_scale_path(update))
+    if snapshot['strategy'] is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请先使用 /strategy 指定比赛策略。')
         return
+
+    def warn(text):
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=text)
+
+    return _collect_scale_data(context.bot, group_id, snapshot, time_limit, users, warn)
+
+
+def _get_day_limit(days):
+    today = clock.now()
+    today = datetime(today.year, today.month, today.day, 0, 0, 0, 0)
+    return today - timedelta(days=days)
+
+
+def _single_flight(key, func, ttl=flight_memo_ttl):
+    now = time.monotonic()
+    with flight_lock:
+        memo = flight_memo.get(key)
+        if memo is not None and memo[0] > now:
+            flight_stats['hit'] += 1
+            return memo[1]
+        call = flight_calls.get(key)
+        leader = call is None
+        if leader:
+            call = {'event': threading.Event()}
+            flight_calls[key] = call
+            flight_stats['computed'] += 1
+        else:
+            flight_stats['coalesced'] += 1
+    if not leader:
+        call['event'].wait()
+        if 'error' in call:
+            raise call['error']
+        return call['result']
+
+    try:
+        call['result'] = func()
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        with flight_lock:
+            del flight_calls[key]
+            if 'error' not in call:
+                now = time.monotonic()
+                for expired in [i for i, j in flight_memo.items() if j[0] <= now]:
+                    del flight_memo[expired]
+                flight_memo[key] = (now + ttl, call['result'])
+        call['event'].set()
+    _log_sampled(f'single flight key={key[:3]} stats={flight_stats}')
+    return call['result']
+
+
+def _get_rank_data(bot, group_id, snapshot, time_limit, warn=None, strategy=None):
+    user_data = _collect_scale_data(bot, group_id, snapshot, time_limit, warn=warn, strategy=strategy)
     user_data.sort(key=lambda x: -x['score'])
-    rank_list = '排名    username    体重变化    分数\n'
-    for i, user in enumerate(user_data):
-        rank_list += f'*{i + 1}* `{user["fullname"]} {user["weight"][0][1] - user["weight"][-1][1]:.2f} {user["score"]:.2f}`\n'
-    context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=rank_list, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+    return user_data
+
+
+def _rank(update, context, time_limit):
+    group_id, user_id, username, message_id = _get_info(update)
+    snapshot = _get_scale_snapshot(_get_scale_path(update))
+    if snapshot['strategy'] is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请先使用 /strategy 指定比赛策略。')
+        return
+    page_id = _get_page_id(_rank_flight_key(group_id, time_limit, snapshot))
+    with page_lock:
+        pages = page_cache.get(page_id)
+    if pages is None:
+        user_data, warnings = _get_shared_rank(context.bot, group_id, snapshot, time_limit)
+        lines = []
+        for i, user in enumerate(user_data):
+            lines.append(f'*{i + 1}* `{escape_markdown(user["fullname"], version=2, entity_type="code")} {user["weight"][0][1] - user["weight"][-1][1]:.2f} {user["score"]:.2f}`\n')
+        _set_pages(page_id, '排名    username    体重变化    分数\n', lines, telegram.ParseMode.MARKDOWN_V2, warnings)
+    else:
+        warnings = pages['warnings']
+    # the warnings belong to the ranking, every request gets them, not only the one that computed it
+    for text in warnings:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=text)
+    _send_page(context.bot, update.effective_chat.id, message_id, page_id)
+
+
+def _rank_flight_key(group_id, time_limit, snapshot, strategy=None):
+    # one key for the same ranking wherever it is asked for: the rank commands, precompute and the HTTP API
+    return group_id, 'rank', time_limit, snapshot['key'], strategy or snapshot['strategy']
+
+
+def _get_shared_rank(bot, group_id, snapshot, time_limit, strategy=None, ttl=flight_memo_ttl):
+    # identical rankings asked for at the same time share one computation, the result is only read by the callers
+    def build():
+        warnings = []
+        return _get_rank_data(bot, group_id, snapshot, time_limit, warnings.append, strategy), warnings
+
+    return _single_flight(_rank_flight_key(group_id, time_limit, snapshot, strategy), build, ttl=ttl)
+
+
+def _get_page_id(key):
+    # callback_data is limited to 64 bytes, so pages are addressed by a digest of the result's cache key
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def _set_pages(page_id, header, lines, parse_mode=None, warnings=()):
+    with page_lock:
+        page_cache[page_id] = {'header': header, 'lines': lines, 'parse_mode': parse_mode, 'warnings': list(warnings)}
+        page_cache.move_to_end(page_id)
+        while len(page_cache) > page_cache_size:
+            page_cache.popitem(last=False)
+
+
+def _has_pages(page_id):
+    with page_lock:
+        return page_id in page_cache
+
+
+def _get_page(page_id, page):
+    with page_lock:
+        pages = page_cache.get(page_id)
+        if pages is None:
+            return None
+        page_cache.move_to_end(page_id)
+    total = max((len(pages['lines']) + page_size - 1) // page_size, 1)
+    page = min(max(page, 0), total - 1)
+    text = pages['header'] + ''.join(pages['lines'][page * page_size:(page + 1) * page_size])
+    markup = None
+    if total > 1:
+        buttons = []
+        if page > 0:
+            buttons.append(telegram.InlineKeyboardButton('上一页', callback_data=f'page:{page_id}:{page - 1}'))
+        buttons.append(telegram.InlineKeyboardButton(f'{page + 1}/{total}', callback_data='page:none'))
+        if page < total - 1:
+            buttons.append(telegram.InlineKeyboardButton('下一页', callback_data=f'page:{page_id}:{page + 1}'))
+        markup = telegram.InlineKeyboardMarkup([buttons])
+    return text, markup, pages['parse_mode']
+
+
+def _send_page(bot, chat_id, message_id, page_id):
+    text, markup, parse_mode = _get_page(page_id, 0)
+    bot.send_message(chat_id=chat_id, reply_to_message_id=message_id, text=text, parse_mode=parse_mode, reply_markup=markup)
+
+
+def page_callback(update, context):
+    query = update.callback_query
+    answer = {}
+    try:
+        if query.data == 'page:none':
+            return
+        _, page_id, page = query.data.split(':')
+        ret = _get_page(page_id, int(page))
+        if ret is None:
+            answer['text'] = '排名已过期，请重新查询'
+            return
+        text, markup, parse_mode = ret
+        context.bot.edit_message_text(chat_id=query.message.chat_id, message_id=query.message.message_id, text=text, parse_mode=parse_mode, reply_markup=markup)
+    except:
+        logging.exception(f"ERROR page callback data={query.data}")
+    finally:
+        # also when the edit failed (e.g. "Message is not modified" after a double tap), or the button keeps spinning
+        try:
+            context.bot.answer_callback_query(query.id, **answer)
+        except:
+            logging.exception(f"ERROR page callback answer data={query.data}")
 
 
 def start(update, context):
@@ -348,6 +1469,53 @@ def print_help_(update, context):
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=help_text)
 
 
+def profile(update, context):
+    group_id, user_id, username, message_id = _get_info(update)
+    try:
+        profile_(update, context)
+    except:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='好像遇到了 bug，请联系 @sqyon')
+        logging.exception(f"ERROR gid={group_id} uid={user_id}")
+        return
+
+
+def profile_(update, context):
+    group_id, user_id, username, message_id = _get_info(update)
+    if user_id not in profile_operators:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='operator only')
+        return
+    inputs = update.to_dict()['message']['text'].split()[1:]
+    if len(inputs) == 0:
+        with profile_lock:
+            running = [f'/{command} {session["calls"]}/{session["limit"]} gid={session["group_id"] or "all"}' for command, session in profile_sessions.items()]
+        text = '正在分析：\n' + '\n'.join(running) if running else '当前没有进行中的性能分析'
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id,
+                                 text=f'{text}\n用法：/profile 命令 [次数] [群组 id]，次数为 0 时结束并发送已收集的结果')
+        return
+    command = inputs[0].lstrip('/')
+    try:
+        limit = int(inputs[1]) if len(inputs) > 1 else profile_default_calls
+        target = str(int(inputs[2])) if len(inputs) > 2 else None
+        if limit < 0 or command not in profile_commands or command == 'profile':
+            raise ValueError
+    except ValueError:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id,
+                                 text='输入格式错误，请按照 /profile 命令 [次数] [群组 id] 输入，例如: /profile ckpt_result 5')
+        return
+
+    with profile_lock:
+        previous = profile_sessions.pop(command, None)
+        if limit > 0:
+            profile_sessions[command] = {'group_id': target, 'chat_id': update.effective_chat.id, 'limit': limit, 'calls': 0, 'stats': None}
+    if previous is not None:
+        _send_profile(context.bot, command, previous)
+    if limit == 0 and previous is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'当前没有 /{command} 的性能分析')
+    elif limit > 0:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id,
+                                 text=f'将分析接下来 {limit} 次 /{command}{" gid=" + target if target else ""} 的调用，完成后发送结果')
+
+
 def new_challenge(update, context):
     context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
     group_id, user_id, username, message_id = _get_info(update)
@@ -363,19 +1531,16 @@ def new_challenge_(update, context):
     if not (_supergroup_only(update, context) and _admin_only(update, context)):
         return
     group_id, user_id, username, message_id = _get_info(update)
-    challenges = _get_challenges()
-    if group_id in challenges:
-        if challenges[group_id]['status'] != 'ended':
+    registry = _get_group_registry(group_id)
+    if registry is not None:
+        if registry['status'] != 'ended':
             context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='请先结束当前挑战')
             return
-        challenges[group_id]['status'] = 'running'
-        challenges[group_id]['challenge_cnt'] += 1
-    if group_id not in challenges:
-        challenges[group_id] = {}
-        challenges[group_id]['status'] = 'running'
-        challenges[group_id]['challenge_cnt'] = 1
-    json.dump(challenges, open(challenges_path, "w"))
-    challenge_cnt = challenges[group_id]['challenge_cnt']
+        registry = {'status': 'running', 'challenge_cnt': registry['challenge_cnt'] + 1}
+    if registry is None:
+        registry = {'status': 'running', 'challenge_cnt': 1}
+    _set_group_registry(group_id, registry)
+    challenge_cnt = registry['challenge_cnt']
     group_path = f'./data/{group_id}'
     _ensure_path(group_path)
     challenge = _get_challenge(group_path, update)
@@ -387,7 +1552,7 @@ def new_challenge_(update, context):
         'end_user': None,
         'challengers': [user_id]
     }
-    json.dump(challenge, open(f'{group_path}/challenge.json', "w"))
+    _dump_json(challenge, f'{group_path}/challenge.json')
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='挑战已开始，请各位参赛选手使用 /join_challenge 加入挑战')
     join_challenge(update, context)
 
@@ -407,18 +1572,16 @@ def end_challenge_(update, context):
     if not (_running_challenge_only(update, context) and _admin_only(update, context)):
         return
     group_id, user_id, username, message_id = _get_info(update)
-    challenges = _get_challenges()
-    if group_id in challenges:
-        challenges[group_id]['status'] = 'ended'
-    json.dump(challenges, open(challenges_path, "w"))
-    challenge_cnt = str(challenges[group_id]['challenge_cnt'])
+    registry = dict(_get_group_registry(group_id), status='ended')
+    _set_group_registry(group_id, registry)
+    challenge_cnt = str(registry['challenge_cnt'])
     group_path = f'./data/{group_id}'
     _ensure_path(group_path)
     challenge = _get_challenge(group_path, update)
     challenge['challenges'][challenge_cnt]['end_time'] = _get_timestamp()
     challenge['challenges'][challenge_cnt]['end_user'] = user_id
     challenge['challenges'][challenge_cnt]['status'] = 'ended'
-    json.dump(challenge, open(f'{group_path}/challenge.json', "w"))
+    _dump_json(challenge, f'{group_path}/challenge.json')
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='挑战已结束!')
 
 
@@ -442,7 +1605,7 @@ def join_challenge_(update, context):
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 已经在挑战中了！')
         return
     challenge['challenges'][challenge_cnt]['challengers'].append(user_id)
-    json.dump(challenge, open(f'./data/{group_id}/challenge.json', "w"))
+    _dump_json(challenge, f'./data/{group_id}/challenge.json')
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 已加入挑战！')
 
 
@@ -476,17 +1639,92 @@ def delete_user_(update, context):
         return
     pos = challenge['challenges'][challenge_cnt]['challengers'].index(user_id)
     challenge['challenges'][challenge_cnt]['challengers'].pop(pos)
-    json.dump(challenge, open(f'./data/{group_id}/challenge.json', "w"))
+    _dump_json(challenge, f'./data/{group_id}/challenge.json')
 
     scale, scale_path = _ensure_scale(update)
     if 'deleted_user_data' not in scale:
         scale['deleted_user_data'] = {}
-    scale['deleted_user_data'][f'{user_id}_{datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}'] = scale[user_id]
+    scale['deleted_user_data'][f'{user_id}_{clock.now().strftime("%Y-%m-%d-%H:%M:%S")}'] = scale[user_id]
     del scale[user_id]
-    json.dump(scale, open(f'{scale_path}/scale.json', "w"))
+    _save_scale(scale, scale_path)
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 已退出挑战！')
 
 
+def import_data(update, context):
+    context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
+    group_id, user_id, username, message_id = _get_info(update)
+    try:
+        import_data_(update, context)
+    except:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='好像遇到了 bug，请联系 @sqyon')
+        logging.exception(f"ERROR gid={group_id} uid={user_id}")
+        return
+
+
+def import_data_(update, context):
+    if not (_running_challenge_only(update, context) and _admin_only(update, context)):
+        return
+    group_id, user_id, username, message_id = _get_info(update)
+    reply = update.message.reply_to_message
+    if reply is None or reply.document is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='请回复需要导入的 CSV 文件使用本命令')
+        return
+
+    inputs = update.to_dict()['message']['text'].split()[1:]
+    if len(inputs) > 0:
+        username = inputs[0].strip().lstrip('@')
+        user_ids = _get_userid(update, context, [username], all_flag=False)
+        if username not in user_ids:
+            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'未找到 @{username}，请正确输入用户名')
+            return
+        user_id = user_ids[username]
+        mention = f'@{username}'
+    else:
+        user_id = str(reply.from_user.id)
+        # not everyone has a username, name them by their full name then, like _get_fullname does
+        mention = f'@{reply.from_user.username}' if reply.from_user.username else reply.from_user.full_name
+
+    challenge, challenge_cnt = _get_latest_challenge(update)
+    if user_id not in challenge['challenges'][challenge_cnt]['challengers']:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'{mention} 没有在挑战中！')
+        return
+
+    content = bytes(context.bot.get_file(reply.document.file_id).download_as_bytearray())
+    records, skipped = _parse_weight_export(content)
+    if not records:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='没有在文件中找到可以导入的体重数据')
+        return
+
+    scale, scale_path = _ensure_scale(update)
+    added = _import_weight_records(scale, user_id, records)
+    _save_scale(scale, scale_path)
+    context.bot.send_message(
+        chat_id=update.effective_chat.id, reply_to_message_id=message_id,
+        text=f'{mention} 导入了 {len(records)} 天的体重记录，新增 {added} 天，跳过 {skipped} 行无效数据')
+
+
+def import_cli(group_id, user_id, file_path):
+    registry = _get_group_registry(group_id)
+    if registry is None:
+        print(f'group {group_id} has no challenge')
+        return 1
+    challenge_cnt = str(registry['challenge_cnt'])
+    challenge = _load_json(f'./data/{group_id}/challenge.json', {'group_id': group_id, 'challenges': {}})
+    if user_id not in challenge['challenges'][challenge_cnt]['challengers']:
+        print(f'user {user_id} is not in challenge {challenge_cnt} of group {group_id}')
+        return 1
+    records, skipped = _parse_weight_export(open(file_path, 'rb').read())
+    if not records:
+        print(f'no weight records found in {file_path}')
+        return 1
+    scale_path = f'./data/{group_id}/{challenge_cnt}'
+    scale = _get_scale(scale_path)
+    added = _import_weight_records(scale, user_id, records)
+    _save_scale(scale, scale_path)
+    print(f'imported {len(records)} days, {added} new, {skipped} rows skipped')
+    return 0
+
+
 def weight(update, context):
     context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
     group_id, user_id, username, message_id = _get_info(update)
@@ -535,14 +1773,247 @@ def weight_(update, context):
 
     scale[user_id]['weight'].append(new_data)
 
-    json.dump(scale, open(f'{scale_path}/scale.json', "w"))
+    _save_scale(scale, scale_path)
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=outputs)
+    _schedule_precompute(context.bot, group_id, scale_path, user_id)
     if len(scale[user_id]['weight']) > 1 and abs(scale[user_id]["weight"][-2][1] - new_data[1]) > 5:
         context.bot.send_message(
             chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'*⚠️和上次的体重变化比较大，请注意是否输入错误⚠️️*',
             parse_mode=telegram.ParseMode.MARKDOWN_V2)
 
 
+def me(update, context):
+    context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
+    group_id, user_id, username, message_id = _get_info(update)
+    try:
+        me_(update, context)
+    except:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='好像遇到了 bug，请联系 @sqyon')
+        logging.exception(f"ERROR gid={group_id} uid={user_id}")
+        return
+
+
+def me_(update, context):
+    if not (_running_challenge_only(update, context) and _in_challenge(update, context)):
+        return
+    group_id, user_id, username, message_id = _get_info(update)
+    entry = _get_weight_aggs(_get_scale_path(update)).get(user_id)
+    if entry is None or entry['pending'] is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'@{username} 你还没有体重记录，请使用 /w 添加')
+        return
+    stats = _weight_stats(entry)
+
+    def average(value):
+        return '无' if value is None else f'{value:.2f} 千克'
+
+    outputs = f'@{username} 的体重统计\n'
+    outputs += f'连续打卡 {stats["streak"]} 天，最长 {stats["best"]} 天，共记录 {stats["count"]} 次\n'
+    outputs += f'最低 {stats["min"]:.2f} 千克，最高 {stats["max"]:.2f} 千克，平均 {stats["mean"]:.2f} 千克，标准差 {stats["std"]:.2f}\n'
+    outputs += f'近 7 天平均 {average(stats["ma7"])}，近 30 天平均 {average(stats["ma30"])}'
+    if entry['height'] is not None:
+        outputs += f'\n当前 BMI {_calc_bmi(stats["current"], entry["height"]):.2f}'
+        if stats['ma7'] is not None and stats['previous7'] is not None:
+            bmi = _calc_bmi(stats['ma7'], entry['height'])
+            outputs += f'，近 7 天平均 BMI {bmi:.2f}，比前 7 天变化了 {bmi - _calc_bmi(stats["previous7"], entry["height"]):.2f}'
+    context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=outputs)
+
+
+def _get_weight_aggs(scale_path):
+    # kept up to date by _save_scale, only a restart or a writer outside this process makes it read scale.json again
+    version = _get_data_version(f'{scale_path}/scale.json')
+    cached = weight_aggs.get(scale_path)
+    if cached is None or cached['version'] != version:
+        scale = _get_scale(scale_path)
+        cached = {'version': version, 'users': {user_id: _update_weight_agg(scale_data) for user_id, scale_data in scale.items() if user_id.isdigit()}}
+        weight_aggs[scale_path] = cached
+    return cached['users']
+
+
+def _weight_stats(entry):
+    # the stored aggregates plus the last weigh-in, which is not folded into them yet
+    agg = dict(entry['agg'])
+    agg['recent'] = list(agg['recent'])
+    data_timestamp, weight_data = entry['pending']
+    _fold_weight_agg(agg, data_timestamp, weight_data)
+    now = clock.timestamp()
+    streak = agg['streak'] if agg['day'] >= clock.now().toordinal() - 1 else 0
+
+    def average(start, end):
+        values = [w for t, w in agg['recent'] if start <= t < end]
+        return sum(values) / len(values) if values else None
+
+    return {
+        'count': agg['count'], 'streak': streak, 'best': agg['best'], 'current': weight_data,
+        'min': agg['min'], 'max': agg['max'], 'mean': agg['mean'], 'std': sqrt(agg['m2'] / agg['count']),
+        'ma7': average(now - 7 * 86400, math.inf), 'ma30': average(now - 30 * 86400, math.inf),
+        'previous7': average(now - 14 * 86400, now - 7 * 86400),
+    }
+
+
+def _get_record_salt(path):
+    # the salt never leaves the machine the log was recorded on, without it the hashed ids cannot be brute forced back
+    salt_path = f'{path}.salt'
+    if not os.path.exists(salt_path):
+        fd = os.open(salt_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(16).hex())
+    with open(salt_path) as f:
+        return f.read().strip()
+
+
+def _anonymize_id(value, salt):
+    digest = int(hmac.new(salt.encode(), str(abs(int(value))).encode(), hashlib.sha256).hexdigest()[:10], 16)
+    return -1000000000000 - digest if int(value) < 0 else digest
+
+
+def _anonymize_text(text, group_id, salt):
+    tokens = text.split()
+    tokens[0] = tokens[0].split('@')[0]
+    for i, token in enumerate(tokens[1:], 1):
+        if token.startswith('@'):
+            # usernames are replaced by the hashed id of the member they belong to, as user<id> like the stub Bot names them
+            with member_lock:
+                found = [key[1] for key, (_, member) in member_cache.items() if key[0] == group_id and member.get('username') == token[1:]]
+            tokens[i] = f'@user{_anonymize_id(found[0], salt) if found else 0}'
+    return ' '.join(tokens)
+
+
+def _record_update(update, context):
+    if 'file' not in record_file:
+        record_file['salt'] = _get_record_salt(record_path)
+        record_file['file'] = open(record_path, 'a', encoding='utf-8', buffering=1)
+    salt = record_file['salt']
+    if update.callback_query is not None and update.effective_chat is not None:
+        text = f'callback:{update.callback_query.data}'
+    elif update.message is not None and update.message.text and update.message.text.startswith('/'):
+        text = _anonymize_text(update.message.text, str(update.effective_chat.id), salt)
+    else:
+        return
+    # a channel post has no sender, it is recorded as sent by the chat, like the lanes count it
+    sender_id = update.effective_user.id if update.effective_user is not None else update.effective_chat.id
+    line = [round(clock.timestamp(), 3), _anonymize_id(update.effective_chat.id, salt), update.effective_chat.type,
+            _anonymize_id(sender_id, salt), text]
+    with record_lock:
+        record_file['file'].write(json.dumps(line, ensure_ascii=False) + '\n')
+
+
+def _track_update(update, context):
+    update_state['update_id'] = max(update_state['update_id'], update.update_id)
+
+
+def _save_update_state(context=None):
+    update_id = update_state['update_id']
+    if update_id > update_state['saved']:
+        _ensure_path(job_path)
+        _dump_json({'update_id': update_id}, update_state_path)
+        update_state['saved'] = update_id
+
+
+def _is_catch_up_weight(update):
+    message = update.message
+    if message is None or not message.text or message.chat.type != 'supergroup':
+        return False
+    # the same test CommandHandler makes, a plain "w 80" is not a command
+    if not message.entities or message.entities[0].type != telegram.MessageEntity.BOT_COMMAND or message.entities[0].offset != 0:
+        return False
+    if message.text[1:message.entities[0].length].split('@')[0] not in catch_up_commands:
+        return False
+    registry = _get_group_registry(str(message.chat.id))
+    return registry is not None and registry['status'] != 'ended'
+
+
+def _catch_up(updater):
+    # updates that piled up while the bot was down, handled in order: weigh-ins are applied per group in one write, the rest go through the dispatcher
+    _ensure_path(job_path)
+    update_state['update_id'] = update_state['saved'] = _load_json(update_state_path, {'update_id': 0})['update_id']
+    summaries = {}
+    offset = update_state['update_id'] + 1 if update_state['update_id'] else None
+    while True:
+        # asking for the next page confirms this one to Telegram, so a page is stored before moving on
+        updates = updater.bot.get_updates(offset=offset, timeout=0, limit=100)
+        if not updates:
+            break
+        weights = {}
+        for update in sorted(updates, key=lambda x: x.update_id):
+            if update.update_id <= update_state['saved']:
+                continue
+            if _is_catch_up_weight(update):
+                weights.setdefault(str(update.message.chat.id), []).append(update)
+                continue
+            # weigh-ins sent before this update, e.g. ahead of a /quit_challenge, are applied first
+            if update.effective_chat is not None:
+                _flush_catch_up_weights(updater.bot, str(update.effective_chat.id), weights, summaries)
+            updater.dispatcher.process_update(update)
+        for group_id in list(weights):
+            _flush_catch_up_weights(updater.bot, group_id, weights, summaries)
+        offset = updates[-1].update_id + 1
+        _save_update_state()
+    if offset is not None:
+        updater.last_update_id = offset
+    for group_id, summary in summaries.items():
+        _announce(updater.bot, int(group_id), _catch_up_text(summary), clock.timestamp())
+    logging.info(f'catch up groups={len(summaries)} weights={sum(len(i["users"]) for i in summaries.values())} update_id={update_state["update_id"]}')
+
+
+def _flush_catch_up_weights(bot, group_id, weights, summaries):
+    updates = weights.pop(group_id, None)
+    if not updates:
+        return
+    try:
+        summary = summaries.setdefault(group_id, {'users': {}, 'rejected': []})
+        _catch_up_weights(bot, group_id, [update.message for update in updates], summary)
+    except:
+        logging.exception(f"ERROR catch up gid={group_id}")
+    update_state['update_id'] = max(update_state['update_id'], updates[-1].update_id)
+
+
+def _catch_up_weights(bot, group_id, messages, summary):
+    challenge_cnt = str(_get_group_registry(group_id)['challenge_cnt'])
+    challenge = _load_json(f'./data/{group_id}/challenge.json', {'group_id': group_id, 'challenges': {}})
+    challengers = challenge['challenges'][challenge_cnt]['challengers']
+    scale_path = f'./data/{group_id}/{challenge_cnt}'
+    scale = _get_scale(scale_path)
+    records = {}
+    for message in messages:
+        user_id = str(message.from_user.id)
+        username = message.from_user.username
+        if user_id not in challengers:
+            summary['rejected'].append(f'@{username} 还未加入挑战')
+            continue
+        try:
+            inputs = float(message.text.split()[1])
+            if inputs < 40 or inputs > 400:
+                raise ValueError
+        except:
+            summary['rejected'].append(f'@{username} {message.text} 不是正确的体重数据')
+            continue
+        records.setdefault(user_id, []).append([str(message.date.timestamp()), inputs])
+    if not records:
+        return
+    for user_id, user_records in records.items():
+        username = _get_username(bot, group_id, user_id)
+        if username in summary['users']:
+            previous = summary['users'][username][0]
+        else:
+            previous = scale[user_id]['weight'][-1][1] if user_id in scale and scale[user_id]['weight'] else None
+        _import_weight_records(scale, user_id, sorted(user_records, key=lambda x: float(x[0])))
+        summary['users'][username] = (previous, scale[user_id]['weight'][-1])
+    _save_scale(scale, scale_path)
+    for user_id in records:
+        _schedule_precompute(bot, group_id, scale_path, user_id)
+
+
+def _catch_up_text(summary):
+    text = 'bot 恢复运行，已按消息发送时间补录离线期间的体重记录：'
+    for username, (previous, latest) in summary['users'].items():
+        text += f'\n@{username} {latest[1]:.2f} 千克（{_get_timestr(latest[0], format="%m-%d %H:%M")}）'
+        if previous is not None and abs(previous - latest[1]) > 5:
+            text += f'，与之前的 {previous:.2f} 千克相差超过 5 千克，请确认'
+    if summary['rejected']:
+        text += '\n以下记录未能补录：\n' + '\n'.join(summary['rejected'])
+    return text
+
+
 def height(update, context):
     context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
     group_id, user_id, username, message_id = _get_info(update)
@@ -573,7 +2044,7 @@ def height_(update, context):
 
     scale[user_id]['height'] = inputs
 
-    json.dump(scale, open(f'{scale_path}/scale.json', "w"))
+    _save_scale(scale, scale_path)
     context.bot.send_message(
         chat_id=update.effective_chat.id, reply_to_message_id=message_id,
         text=f'@{username} 更新身高记录 {inputs} 米')
@@ -610,7 +2081,7 @@ def strategy_(update, context):
 
     scale, scale_path = _ensure_scale(update)
     scale['strategy'] = inputs
-    json.dump(scale, open(f'{scale_path}/scale.json', "w"))
+    _save_scale(scale, scale_path)
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'已成功切换为策略 {inputs}')
 
 
@@ -628,10 +2099,7 @@ def week_rank(update, context):
 def week_rank_(update, context):
     if not _running_challenge_only(update, context):
         return
-    today = datetime.now()
-    today = datetime(today.year, today.month, today.day, 0, 0, 0, 0)
-    time_limit = today - timedelta(days=7)
-    _rank(update, context, time_limit)
+    _rank(update, context, _get_day_limit(7))
 
 
 def overall_rank(update, context):
@@ -674,10 +2142,130 @@ def rank_(update, context):
     except:
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='请输入整数。')
         return
-    today = datetime.now()
-    today = datetime(today.year, today.month, today.day, 0, 0, 0, 0)
-    time_limit = today - timedelta(days=inputs)
-    _rank(update, context, time_limit)
+    _rank(update, context, _get_day_limit(inputs))
+
+
+def league(update, context):
+    context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
+    group_id, user_id, username, message_id = _get_info(update)
+    try:
+        league_(update, context)
+    except:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='好像遇到了 bug，请联系 @sqyon')
+        logging.exception(f"ERROR gid={group_id} uid={user_id}")
+        return
+
+
+def league_(update, context):
+    if not _supergroup_only(update, context):
+        return
+    group_id, user_id, username, message_id = _get_info(update)
+    inputs = update.to_dict()['message']['text'].split()[1:]
+    if inputs and inputs[0] in ['join', 'leave']:
+        if not _admin_only(update, context):
+            return
+        text = _league_join(group_id, inputs[1:]) if inputs[0] == 'join' else _league_leave(group_id)
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=text)
+        return
+
+    with league_lock:
+        name, entry = _get_group_league(group_id)
+        if entry is not None:
+            strategy, group_ids = entry['strategy'], list(entry['groups'])
+    if entry is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id,
+                                 text='本群还没有加入联赛，管理员可以使用 /league join 联赛名 加入或创建联赛')
+        return
+    boards = [board for board in (_get_league_board(context.bot, i, strategy) for i in group_ids) if board is not None]
+    # the pages stay valid until one of the member groups changes or the member list does
+    page_id = _get_page_id(('league', name, strategy, tuple((board['group_id'], board['key']) for board in boards)))
+    if not _has_pages(page_id):
+        # every board is sorted already, so the top of the league only needs a k-way merge of their heads
+        lines = []
+        for i, row in enumerate(itertools.islice(heapq.merge(*[board['rows'] for board in boards]), league_top)):
+            fullname, title = (escape_markdown(text, version=2, entity_type='code') for text in row[3:5])
+            lines.append(f'*{i + 1}* `{fullname} {title} {-row[0]:.2f}`\n')
+        _set_pages(page_id, f'联赛 `{name}` {metrics[strategy]["name"]}\n排名    username    群组    分数\n', lines, telegram.ParseMode.MARKDOWN_V2)
+    _send_page(context.bot, update.effective_chat.id, message_id, page_id)
+
+
+def _get_leagues():
+    if 'leagues' not in leagues:
+        leagues['leagues'] = _load_json(leagues_path, {})
+    return leagues['leagues']
+
+
+def _get_group_league(group_id):
+    for name, entry in _get_leagues().items():
+        if group_id in entry['groups']:
+            return name, entry
+    return None, None
+
+
+def _league_join(group_id, inputs):
+    if not inputs or not league_name_pattern.match(inputs[0]):
+        return '请输入联赛名（字母、数字或下划线，最长 32 个字符）'
+    name = inputs[0]
+    with league_lock:
+        current, entry = _get_group_league(group_id)
+        if entry is not None:
+            return f'本群已在联赛 {current} 中，请先使用 /league leave 退出'
+        entry = _get_leagues().get(name)
+        created = entry is None
+        if created:
+            # a new league keeps the strategy of the group that opened it, every member is scored by it
+            registry = _get_group_registry(group_id)
+            if registry is None or registry['status'] == 'ended':
+                return '没有正在进行的挑战'
+            strategy = _get_scale_snapshot(f'./data/{group_id}/{registry["challenge_cnt"]}')['strategy']
+            if strategy is None:
+                return '请先使用 /strategy 指定比赛策略，新联赛沿用本群的策略。'
+            entry = {'strategy': strategy, 'groups': []}
+            _get_leagues()[name] = entry
+        entry['groups'].append(group_id)
+        _dump_json(_get_leagues(), leagues_path)
+        count = len(entry['groups'])
+    if created:
+        return f'已创建联赛 {name}，排名策略：{metrics[entry["strategy"]]["name"]}，其他群组的管理员可以使用 /league join {name} 加入'
+    return f'本群已加入联赛 {name}，排名策略：{metrics[entry["strategy"]]["name"]}，共 {count} 个群组'
+
+
+def _league_leave(group_id):
+    with league_lock:
+        name, entry = _get_group_league(group_id)
+        if entry is None:
+            return '本群还没有加入联赛'
+        entry['groups'].remove(group_id)
+        if not entry['groups']:
+            del _get_leagues()[name]
+        _dump_json(_get_leagues(), leagues_path)
+    league_boards.pop((group_id, entry['strategy']), None)
+    return f'本群已退出联赛 {name}'
+
+
+def _get_league_board(bot, group_id, strategy):
+    # each member group keeps its own sorted board, rebuilt only when that group's snapshot has changed
+    registry = _get_group_registry(group_id)
+    if registry is None or registry['status'] == 'ended':
+        league_boards.pop((group_id, strategy), None)
+        return None
+    scale_path = f'./data/{group_id}/{registry["challenge_cnt"]}'
+    snapshot = _get_scale_snapshot(scale_path)
+    key = (scale_path, snapshot['key'])
+    board = league_boards.get((group_id, strategy))
+    if board is not None and board['key'] == key:
+        return board
+
+    def build():
+        title = bot.get_chat(int(group_id)).title
+        user_data = _get_rank_data(bot, group_id, snapshot, datetime.min, strategy=strategy)
+        # rows compare as (-score, group, user), the order heapq.merge needs across boards
+        rows = sorted((-float(user['score']), group_id, user['user_id'], user['fullname'], title) for user in user_data)
+        return {'group_id': group_id, 'key': key, 'rows': rows}
+
+    board = _single_flight((group_id, 'league', strategy, key), build)
+    league_boards[(group_id, strategy)] = board
+    return board
 
 
 def plot(update, context):
@@ -697,7 +2285,7 @@ def plot_(update, context):
     group_id, user_id, username, message_id = _get_info(update)
     inputs = update.to_dict()['message']['text']
     compare_username = [username]
-    compare_day = 14
+    compare_day = plot_default_days
     all_flag = False
     try:
         inputs = inputs.split()[1:]
@@ -713,9 +2301,7 @@ def plot_(update, context):
                 context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
     except:
         raise ValueError
-    today = datetime.now()
-    today = datetime(today.year, today.month, today.day, 0, 0, 0, 0)
-    time_limit = today - timedelta(days=compare_day)
+    time_limit = _get_day_limit(compare_day)
     if len(compare_username) > 1 or all_flag:
         compare_userid = _get_userid(update, context, compare_username, all_flag)
         for cmp_username in compare_username:
@@ -724,28 +2310,220 @@ def plot_(update, context):
                 context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
     else:
         compare_userid = {compare_username[0]: user_id}
+        snapshot = _get_scale_snapshot(_get_scale_path(update))
+        cached = plot_cache.get((group_id, user_id, compare_day))
+        if cached is not None and cached['version'] == (time_limit, snapshot['key']) and os.path.exists(cached['path']):
+            context.bot.send_photo(chat_id=update.effective_chat.id, reply_to_message_id=message_id, photo=open(cached['path'], 'rb'))
+            return
     users_data = _get_scale_data(update, context, time_limit, users=compare_userid)
-    plt.clf()
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
-    plt.gca().xaxis.set_major_locator(mdates.DayLocator())
-    for user_data in users_data:
-        weights = []
-        timestamps = []
-        for i, j in user_data['weight']:
-            timestamps.append(datetime.fromtimestamp((float(i))))
-            weights.append(j)
-        maxi = int(np.argmax(weights))
-        mini = int(np.argmin(weights))
-        plt.plot(timestamps, weights, label=f'@{user_data["username"]}', marker='o')
-        plt.annotate(weights[maxi], xy=(timestamps[maxi], weights[maxi]))
-        plt.annotate(weights[mini], xy=(timestamps[mini], weights[mini]))
-    plt.legend()
-    plt.title(f'{" ".join(list(compare_userid.keys()))} in last {compare_day} days')
-    plt.xlabel('time')
-    plt.ylabel('weight')
     _ensure_path(f'./pic')
-    plt.savefig(f'./pic/{username}.png', dpi=120)
-    context.bot.send_photo(chat_id=update.effective_chat.id, reply_to_message_id=message_id, photo=open(f'./pic/{username}.png', 'rb'))
+    path = f'./pic/{username}.png'
+    _render_plot(users_data, f'{" ".join(list(compare_userid.keys()))} in last {compare_day} days', path)
+    context.bot.send_photo(chat_id=update.effective_chat.id, reply_to_message_id=message_id, photo=open(path, 'rb'))
+
+
+def _render_plot(users_data, title, path):
+    if Image is not None and len(users_data) <= plot_fast_users:
+        _render_plot_fast(users_data, title, path)
+    else:
+        _render_plot_matplotlib(users_data, title, path)
+
+
+def _render_plot_matplotlib(users_data, title, path):
+    # matplotlib takes a while and tens of MB to import, only a process that draws with it pays for that
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+    with plot_lock:
+        plt.clf()
+        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
+        plt.gca().xaxis.set_major_locator(mdates.DayLocator())
+        for user_data in users_data:
+            weights = []
+            timestamps = []
+            for i, j in user_data['weight']:
+                timestamps.append(datetime.fromtimestamp((float(i))))
+                weights.append(j)
+            maxi = int(np.argmax(weights))
+            mini = int(np.argmin(weights))
+            plt.plot(timestamps, weights, label=f'@{user_data["username"]}', marker='o')
+            plt.annotate(weights[maxi], xy=(timestamps[maxi], weights[maxi]))
+            plt.annotate(weights[mini], xy=(timestamps[mini], weights[mini]))
+        plt.legend()
+        plt.title(title)
+        plt.xlabel('time')
+        plt.ylabel('weight')
+        plt.savefig(path, dpi=120)
+
+
+def _plot_font(size):
+    font = plot_fonts.get(size)
+    if font is None:
+        try:
+            font = ImageFont.load_default(size=size)
+        except TypeError:
+            # Pillow before 10.1 only has the fixed size bitmap font
+            font = ImageFont.load_default()
+        plot_fonts[size] = font
+    return font
+
+
+def _plot_text(draw, x, y, text, font, ha='center', va='center', fill='black'):
+    box = draw.textbbox((0, 0), text, font=font)
+    width, height = box[2] - box[0], box[3] - box[1]
+    x -= {'left': 0, 'center': width / 2, 'right': width}[ha] + box[0]
+    y -= {'top': 0, 'center': height / 2, 'bottom': height}[va] + box[1]
+    draw.text((x, y), text, fill=fill, font=font)
+
+
+def _plot_ticks(low, high, count=6):
+    step = (high - low) / count
+    magnitude = 10 ** math.floor(math.log10(step))
+    step = next(i * magnitude for i in [1, 2, 2.5, 5, 10] if i * magnitude >= step)
+    first = math.ceil(low / step) * step
+    return [round(first + i * step, 6) for i in range(int((high - first) / step + 1e-9) + 1)]
+
+
+def _render_plot_fast(users_data, title, path):
+    # the same chart as _render_plot_matplotlib, drawn straight onto a Pillow image
+    width, height = plot_size
+    left, right, top, bottom = 80, width - 24, 48, height - 64
+    image = Image.new('RGB', plot_size, 'white')
+    draw = ImageDraw.Draw(image)
+    font = _plot_font(13)
+
+    series = [(np.asarray(user_data['weight']['timestamp'], dtype=float), np.asarray(user_data['weight']['weight'], dtype=float))
+              for user_data in users_data]
+    if series:
+        x_low, x_high = min(float(x.min()) for x, y in series), max(float(x.max()) for x, y in series)
+        y_low, y_high = min(float(y.min()) for x, y in series), max(float(y.max()) for x, y in series)
+    else:
+        x_high = clock.timestamp()
+        x_low, y_low, y_high = x_high - 86400, 0.0, 1.0
+    if x_high == x_low:
+        x_low, x_high = x_low - 43200, x_high + 43200
+    if y_high == y_low:
+        y_low, y_high = y_low - 1, y_high + 1
+    # 5% of room on every side, like matplotlib's default margins
+    x_pad, y_pad = (x_high - x_low) * 0.05, (y_high - y_low) * 0.05
+    x_low, x_high, y_low, y_high = x_low - x_pad, x_high + x_pad, y_low - y_pad, y_high + y_pad
+
+    def to_x(timestamps):
+        return left + (timestamps - x_low) / (x_high - x_low) * (right - left)
+
+    def to_y(weights):
+        return bottom - (weights - y_low) / (y_high - y_low) * (bottom - top)
+
+    for tick in _plot_ticks(y_low, y_high):
+        y = float(to_y(tick))
+        draw.line([(left - 4, y), (left, y)], fill='black')
+        _plot_text(draw, left - 7, y, f'{tick:g}', font, ha='right')
+    days = []
+    day = datetime.fromtimestamp(x_low).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    while day.timestamp() <= x_high:
+        days.append(day)
+        day += timedelta(days=1)
+    for day in days[::max(1, math.ceil(len(days) / plot_max_date_labels))]:
+        x = float(to_x(day.timestamp()))
+        draw.line([(x, bottom), (x, bottom + 4)], fill='black')
+        _plot_text(draw, x, bottom + 7, day.strftime('%m-%d'), font, va='top')
+    draw.rectangle([left, top, right, bottom], outline='black')
+
+    for n, (timestamps, weights) in enumerate(series):
+        color = plot_colors[n % len(plot_colors)]
+        points = list(zip(to_x(timestamps).tolist(), to_y(weights).tolist()))
+        if len(points) > 1:
+            draw.line(points, fill=color, width=2, joint='curve')
+        for x, y in points:
+            draw.ellipse([x - 3, y - 3, x + 3, y + 3], fill=color)
+        for i in {int(np.argmax(weights)), int(np.argmin(weights))}:
+            _plot_text(draw, points[i][0], points[i][1], str(users_data[n]['weight'][i][1]), font, ha='left', va='bottom')
+
+    if users_data:
+        labels = [f'@{user_data["username"]}' for user_data in users_data]
+        line_height = 18
+        box_width = max(draw.textbbox((0, 0), label, font=font)[2] for label in labels) + 44
+        x, y = right - box_width - 8, top + 8
+        draw.rectangle([x, y, x + box_width, y + line_height * len(labels) + 8], fill='white', outline='#cccccc')
+        for n, label in enumerate(labels):
+            color = plot_colors[n % len(plot_colors)]
+            middle = y + 4 + line_height * n + line_height / 2
+            draw.line([(x + 6, middle), (x + 30, middle)], fill=color, width=2)
+            draw.ellipse([x + 15, middle - 3, x + 21, middle + 3], fill=color)
+            _plot_text(draw, x + 36, middle, label, font, ha='left')
+
+    _plot_text(draw, (left + right) / 2, top / 2, title, _plot_font(15))
+    _plot_text(draw, (left + right) / 2, height - 18, 'time', font)
+    label = Image.new('RGB', (draw.textbbox((0, 0), 'weight', font=font)[2] + 4, 20), 'white')
+    _plot_text(ImageDraw.Draw(label), label.width / 2, 10, 'weight', font)
+    label = label.rotate(90, expand=True)
+    image.paste(label, (12, int((top + bottom - label.height) / 2)))
+    image.save(path)
+
+
+def _schedule_precompute(bot, group_id, scale_path, user_id):
+    if not precompute_enabled or precompute_stop.is_set():
+        return
+    with precompute_lock:
+        pending = precompute_pending.get(group_id)
+        if pending is not None:
+            pending['timer'].cancel()
+        users = pending['users'] if pending is not None else set()
+        users.add(user_id)
+        # a burst of weigh-ins in one group only triggers one refresh once it has been quiet for precompute_delay
+        timer = threading.Timer(precompute_delay, _precompute, args=(bot, group_id, scale_path))
+        timer.daemon = True
+        precompute_pending[group_id] = {'timer': timer, 'users': users}
+        timer.start()
+
+
+def _precompute_budget_left():
+    now = time.monotonic()
+    while precompute_cpu and precompute_cpu[0][0] < now - precompute_window:
+        precompute_cpu.pop(0)
+    return sum(i[1] for i in precompute_cpu) < precompute_cpu_budget * precompute_window
+
+
+def _precompute(bot, group_id, scale_path):
+    with precompute_lock:
+        pending = precompute_pending.pop(group_id, None)
+    if pending is None:
+        return
+    with precompute_run_lock:
+        if precompute_stop.is_set():
+            return
+        if not _precompute_budget_left():
+            logging.info(f'precompute skipped gid={group_id}, cpu budget used up')
+            return
+        start = time.thread_time()
+        _set_log_context(group_id, 'precompute')
+        try:
+            snapshot = _get_scale_snapshot(scale_path)
+            if snapshot['strategy'] is not None:
+                for time_limit in [_get_day_limit(7), datetime.min]:
+                    _get_shared_rank(bot, group_id, snapshot, time_limit, ttl=precompute_ttl)
+                for user_id in pending['users']:
+                    _warm_plot(bot, group_id, snapshot, user_id, plot_default_days)
+            with league_lock:
+                name, entry = _get_group_league(group_id)
+            if entry is not None:
+                _get_league_board(bot, group_id, entry['strategy'])
+        except:
+            logging.exception(f"ERROR precompute gid={group_id}")
+        finally:
+            precompute_cpu.append((time.monotonic(), time.thread_time() - start))
+            _set_log_context()
+
+
+def _warm_plot(bot, group_id, snapshot, user_id, compare_day):
+    time_limit = _get_day_limit(compare_day)
+    username = _get_username(bot, group_id, user_id)
+    users_data = _collect_scale_data(bot, group_id, snapshot, time_limit, users={username: user_id})
+    if len(users_data) == 0:
+        return
+    _ensure_path(f'./pic')
+    path = f'./pic/{group_id}_{user_id}_{compare_day}.png'
+    _render_plot(users_data, f'{username} in last {compare_day} days', path)
+    plot_cache[(group_id, user_id, compare_day)] = {'version': (time_limit, snapshot['key']), 'path': path}
 
 
 def ckpt_add(update, context):
@@ -770,10 +2548,6 @@ def ckpt_add_(update, context):
             text=f'输入格式错误，请按照 开始年-月-日-小时 结束年-月-日-小时 输入，例如:2020-10-1-15 2020-10-1-21')
         return
 
-    ckpt, ckpt_path = _ensure_ckpt(update)
-    ckpt['ckpt_cnt'] += 1
-    ckpt_cnt = ckpt['ckpt_cnt']
-
     start_time, end_time = ret
     if not start_time < end_time:
         context.bot.send_message(
@@ -781,62 +2555,15 @@ def ckpt_add_(update, context):
             text=f'结束时间必须在开始时间之后')
         return
 
-    now = datetime.now()
+    with _get_ckpt_settle_lock(group_id):
+        ckpt, ckpt_path = _ensure_ckpt(update)
+        ckpt['ckpt_cnt'] += 1
+        ckpt_cnt = ckpt['ckpt_cnt']
+        ckpt['ckpt'][str(ckpt_cnt)] = _Checkpoint(start_time.timestamp(), end_time.timestamp(), 'active', False)
+        _dump_ckpt(ckpt, ckpt_path)
 
-    if end_time <= now:
-        status = 'ended'
-        run_time = now + timedelta(seconds=1)
-    elif start_time <= now <= end_time:
-        status = 'running'
-        run_time = end_time
-    else:
-        status = 'pending'
-        run_time = end_time
-        time_window = f"{_get_timestr(start_time.timestamp(), format='%Y-%m-%d-%H')} {_get_timestr(end_time.timestamp(), format='%Y-%m-%d-%H')}"
-        if start_time - now > timedelta(hours=12):
-            text = f'请大家准备好参加 checkpoint 数据统计，时间窗口为 {time_window}'
-            job_dict = {
-                'id': datetime.now().timestamp(),
-                'func': 'print_alarm',
-                'timestamp': (start_time - timedelta(hours=12)).timestamp(),
-                'args': {'chat_id': update.effective_chat.id, 'text': text, 'ckpt_num': ckpt_cnt, 'ckpt_path': ckpt_path}
-            }
-            start_job(job_dict, context.job_queue)
-        else:
-            text = f'请大家准备好参加 checkpoint 数据统计，时间窗口为 {time_window}'
-            job_dict = {
-                'id': datetime.now().timestamp(),
-                'func': 'print_alarm',
-                'timestamp': (now + timedelta(seconds=1)).timestamp(),
-                'args': {'chat_id': update.effective_chat.id, 'text': text, 'ckpt_num': ckpt_cnt, 'ckpt_path': ckpt_path}
-            }
-            start_job(job_dict, context.job_queue)
-        text = f'请大家准备好参加 checkpoint 数据统计，时间窗口为 {time_window}'
-        job_dict = {
-            'id': datetime.now().timestamp(),
-            'func': 'print_alarm',
-            'timestamp': start_time.timestamp(),
-            'args': {'chat_id': update.effective_chat.id, 'text': text, 'ckpt_num': ckpt_cnt, 'ckpt_path': ckpt_path}
-        }
-        start_job(job_dict, context.job_queue)
-
-    ckpt['ckpt'][ckpt_cnt] = {'start': start_time.timestamp(), 'end': end_time.timestamp(), 'result': {}, 'status': status}
-    json.dump(ckpt, open(f'{ckpt_path}/ckpt.json', "w"))
-
-    _, scale_path = _ensure_scale(update)
-    job_dict = {
-        'id': datetime.now().timestamp(),
-        'func': 'calc_ckpt_result',
-        'timestamp': run_time.timestamp(),
-        'args': {
-            'ckpt_path': ckpt_path,
-            'scale_path': scale_path,
-            'ckpt_num': ckpt_cnt,
-            'info': (group_id, user_id, username, message_id),
-            'chat_id': update.effective_chat.id,
-        }
-    }
-    start_job(job_dict, context.job_queue)
+    _push_ckpt_events(group_id, ckpt_path, str(ckpt_cnt), ckpt['ckpt'][str(ckpt_cnt)], announce=True)
+    _schedule_ckpt_engine(context.job_queue)
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'已成功添加新的 checkpoint')
 
 
@@ -859,11 +2586,11 @@ def ckpt_list_(update, context):
     ckpt_str = []
     cnt = 0
     for ckpt_id, ckpt in ckpts['ckpt'].items():
-        if ckpt['status'] in ['pending', 'running', 'ended']:
+        if _ckpt_status(ckpt) in ckpt_live_status:
             cnt += 1
-            start_time = _get_timestr(ckpt['start'], '%Y-%m-%d-%H')
-            end_time = _get_timestr(ckpt['end'], '%Y-%m-%d-%H')
-            ckpt_str.append([f'{ckpt_id}  {start_time}  {end_time}\n', float(ckpt['end'])])
+            start_time = _get_timestr(ckpt.start, '%Y-%m-%d-%H')
+            end_time = _get_timestr(ckpt.end, '%Y-%m-%d-%H')
+            ckpt_str.append([f'{ckpt_id}  {start_time}  {end_time}\n', ckpt.end])
     ckpt_str = sorted(ckpt_str, key=lambda x: x[1])
     for i in ckpt_str:
         ret_str += i[0]
@@ -893,12 +2620,16 @@ def ckpt_del_(update, context):
     except:
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请正确输入被删除的编号')
         return
-    ckpts, ckpt_path = _ensure_ckpt(update)
-    if inputs not in ckpts['ckpt'] or ckpts['ckpt'][inputs]['status'] not in ['pending', 'running', 'ended']:
+    with _get_ckpt_settle_lock(group_id):
+        ckpts, ckpt_path = _ensure_ckpt(update)
+        if inputs in ckpts['ckpt'] and _ckpt_status(ckpts['ckpt'][inputs]) in ckpt_live_status:
+            ckpts['ckpt'][inputs].status = 'deleted'
+            _dump_ckpt(ckpts, ckpt_path)
+        else:
+            inputs = None
+    if inputs is None:
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请正确输入被删除的编号')
         return
-    ckpts['ckpt'][inputs]['status'] = 'deleted'
-    json.dump(ckpts, open(f'{ckpt_path}/ckpt.json', 'w'))
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'检查点已被删除')
 
 
@@ -923,45 +2654,36 @@ def ckpt_result_(update, context):
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请正确输入检查点的编号')
         return
     ckpts, ckpt_path = _ensure_ckpt(update)
-    if inputs not in ckpts['ckpt'] or ckpts['ckpt'][inputs]['status'] not in ['pending', 'running', 'ended']:
+    if inputs not in ckpts['ckpt'] or _ckpt_status(ckpts['ckpt'][inputs]) not in ckpt_live_status:
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请正确输入检查点的编号')
         return
-    end_time = ckpts['ckpt'][inputs]['end']
-    end_time = datetime.fromtimestamp(float(end_time))
-    if datetime.now() <= end_time:
+    if _ckpt_status(ckpts['ckpt'][inputs]) != 'ended':
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请等待检查点结束')
         return
-    if ckpts['ckpt'][inputs]['status'] != 'ended':
-        _, scale_path = _ensure_scale(update)
-        job_dict = {
-            'id': datetime.now().timestamp(),
-            'func': 'calc_ckpt_result',
-            'timestamp': (datetime.now() + timedelta(seconds=1)).timestamp(),
-            'args': {
-                'ckpt_path': ckpt_path,
-                'scale_path': scale_path,
-                'ckpt_num': inputs,
-                'info': (group_id, user_id, username, message_id),
-                'chat_id': update.effective_chat.id,
-            }
-        }
-        start_job(job_dict, context.job_queue)
-        time.sleep(2)
+    if not _ckpt_calculated(ckpts['ckpt'][inputs]):
+        # the result event has not fired yet, settle it here instead of waiting for the timer,
+        # unless the engine got there first while this waited for the lock
+        miss_user = None
+        with _get_ckpt_settle_lock(group_id):
+            ckpts, ckpt_path = _ensure_ckpt(update)
+            if not _ckpt_calculated(ckpts['ckpt'][inputs]):
+                miss_user = _calc_ckpt(context.bot, group_id, ckpts['ckpt'][inputs], _get_scale_snapshot(ckpt_path))
+                _dump_ckpt(ckpts, ckpt_path)
+        if miss_user is not None:
+            context.bot.send_message(chat_id=update.effective_chat.id, text=_ckpt_done_text(ckpts['ckpt'][inputs], miss_user))
     history_min = {}
     next_goal = {}
 
-    scale, scale_path = _ensure_scale(update)
-    for user_id in scale:
-        if not user_id.isdigit():
-            continue
-        if len(scale[user_id]["weight"]) > 0:
-            history_min[user_id] = float(scale[user_id]["weight"][0][1])
+    snapshot = _get_scale_snapshot(ckpt_path)
+    for user_id, challenger in snapshot['challengers'].items():
+        if len(challenger.series) > 0:
+            history_min[user_id] = float(challenger.series.weights[0])
 
     for ckpt_id, ckpt in ckpts['ckpt'].items():
         if ckpt_id > inputs:
             continue
         if ckpt_id == inputs:
-            for user_id, scale in ckpt['result'].items():
+            for user_id, scale in ckpt.result_items():
                 if not scale:
                     next_goal[user_id] = 0x3fffffff
                     continue
@@ -970,9 +2692,9 @@ def ckpt_result_(update, context):
                 else:
                     next_goal[user_id] = min(next_goal[user_id], float(scale[1]))
             continue
-        if ckpt['status'] != 'ended':
+        if _ckpt_status(ckpt) != 'ended' or not _ckpt_calculated(ckpt):
             continue
-        for user_id, scale in ckpt['result'].items():
+        for user_id, scale in ckpt.result_items():
             if not scale:
                 continue
             if user_id not in history_min:
@@ -991,7 +2713,7 @@ def ckpt_result_(update, context):
 
     ckpt_preview = {}
 
-    for user_id, scale in ckpts['ckpt'][inputs]['result'].items():
+    for user_id, scale in ckpts['ckpt'][inputs].result_items():
         username = _get_username(context.bot, group_id, user_id)
         if user_id not in next_goal:
             ckpt_preview[username] = '暂无数据'
@@ -1013,6 +2735,152 @@ def ckpt_result_(update, context):
         text += f'{username}: {preview}\n'
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=text)
 
+
+def forecast(update, context):
+    context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.TYPING)
+    group_id, user_id, username, message_id = _get_info(update)
+    try:
+        forecast_(update, context)
+    except:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='好像遇到了 bug，请联系 @sqyon')
+        logging.exception(f"ERROR gid={group_id} uid={user_id}")
+        return
+
+
+def forecast_(update, context):
+    if not _running_challenge_only(update, context):
+        return
+    group_id, user_id, username, message_id = _get_info(update)
+    inputs = update.to_dict()['message']['text'].split()[1:]
+    ckpts, ckpt_path = _ensure_ckpt(update)
+    if inputs:
+        ckpt_n = inputs[0]
+        if ckpt_n not in ckpts['ckpt'] or _ckpt_status(ckpts['ckpt'][ckpt_n]) not in ['pending', 'running'] or _ckpt_calculated(ckpts['ckpt'][ckpt_n]):
+            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='请输入还没有结束的检查点的编号')
+            return
+    else:
+        ckpt_n = _next_ckpt(ckpts)
+        if ckpt_n is None:
+            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='没有即将到来的检查点')
+            return
+    snapshot = _get_scale_snapshot(ckpt_path)
+    # the projection moves with the clock, an hour-old forecast is still close enough
+    key = ('forecast', group_id, ckpt_n, snapshot['key'], _get_data_version(f'{ckpt_path}/ckpt.json'), int(clock.timestamp() // 3600))
+    page_id = _get_page_id(key)
+    if not _has_pages(page_id):
+        ckpt = ckpts['ckpt'][ckpt_n]
+        forecast = _forecast_ckpt(snapshot, ckpts, ckpt_n)
+        lines = []
+        for i in np.argsort(-np.nan_to_num(forecast['weight'] - forecast['target'], nan=-np.inf), kind='stable'):
+            name = _get_username(context.bot, group_id, forecast['user_id'][i])
+            if forecast['kind'][i] == 'unknown':
+                lines.append(f'{name}: 数据不足\n')
+                continue
+            verdict = '通过' if forecast['weight'][i] < forecast['target'][i] else '未通过'
+            label = '已打卡' if forecast['kind'][i] == 'recorded' else '预计'
+            lines.append(f'{name}: {label} {forecast["weight"][i]:.2f}，目标 {forecast["target"][i]:.2f}，{verdict}\n')
+        header = f'检查点 {ckpt_n}（{_ckpt_time_window(ckpt)}）按最近 {forecast_window.days} 天的趋势预测：\n'
+        header += f'通过 {forecast["passed"]} 人，未通过 {forecast["failed"]} 人，数据不足 {forecast["unknown"]} 人\n'
+        _set_pages(page_id, header, lines)
+    _send_page(context.bot, update.effective_chat.id, message_id, page_id)
+
+
+def _next_ckpt(ckpts):
+    upcoming = [(ckpt.end, ckpt_n) for ckpt_n, ckpt in ckpts.get('ckpt', {}).items()
+                if _ckpt_status(ckpt) in ['pending', 'running'] and not _ckpt_calculated(ckpt)]
+    return min(upcoming)[1] if upcoming else None
+
+
+def _fit_trends(group, t, y, groups):
+    # one line per group at once: the weighted sums of all groups come out of np.bincount, no per-user loop
+    decay = np.exp2(t / forecast_half_life)
+    weight = decay
+    for iteration in range(forecast_iterations + 1):
+        s = np.bincount(group, weight, groups)
+        sx = np.bincount(group, weight * t, groups)
+        sy = np.bincount(group, weight * y, groups)
+        sxx = np.bincount(group, weight * t * t, groups)
+        sxy = np.bincount(group, weight * t * y, groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = s * sxx - sx * sx
+            slope = np.where(denominator > 1e-9 * np.maximum(s, 1) ** 2, (s * sxy - sx * sy) / denominator, 0.0)
+            intercept = (sy - slope * sx) / s
+        if iteration == forecast_iterations:
+            break
+        # a mistyped reading lands far outside its group's median absolute residual and drops out of the next fit
+        residual = np.abs(y - intercept[group] - slope[group] * t)
+        scale = np.maximum(1.4826 * _group_medians(group, residual, groups), forecast_min_scale)
+        weight = decay * np.square(np.clip(1 - np.square(residual / (forecast_tukey * scale[group])), 0, None))
+    return intercept, slope
+
+
+def _group_medians(group, values, groups):
+    if len(values) == 0:
+        return np.zeros(groups)
+    # group is sorted, so one sort of group + a fraction below 1 orders the values inside every group
+    span = values.max() + 1
+    ordered = (np.sort(group + values / span) - group) * span
+    counts = np.bincount(group, minlength=groups)
+    middle = np.minimum(np.cumsum(counts) - counts + np.maximum(counts - 1, 0) // 2, len(values) - 1)
+    return np.where(counts > 0, ordered[middle], 0.0)
+
+
+def _forecast_ckpt(snapshot, ckpts, ckpt_n):
+    ckpt = ckpts['ckpt'][ckpt_n]
+    now = clock.timestamp()
+    start, end = ckpt.start, ckpt.end
+    users = snapshot['users']
+    timestamps, weights = snapshot['records']['timestamp'], snapshot['records']['weight']
+    counts = users['count'].astype(np.int64)
+    group = np.repeat(np.arange(len(users)), counts)
+
+    # the bar is the running minimum ckpt_result_ checks against: the first weight and every settled checkpoint
+    target = np.full(len(users), np.nan)
+    target[counts > 0] = weights[users['offset'][counts > 0].astype(np.int64)]
+    user_ids = users['user_id'].astype(str).tolist()
+    position = dict(zip(user_ids, range(len(user_ids))))
+    for other_n, other in ckpts['ckpt'].items():
+        if other_n == ckpt_n or _ckpt_status(other) != 'ended' or not _ckpt_calculated(other):
+            continue
+        results = [(position[user_id], float(result[1])) for user_id, result in other.result_items() if result and user_id in position]
+        if results:
+            index, value = zip(*results)
+            np.fmin.at(target, list(index), list(value))
+
+    # whoever already weighed in during the window has their result, like _calc_ckpt it is the first reading
+    inside = np.flatnonzero((timestamps > start) & (timestamps < end))
+    recorded = np.full(len(users), np.nan)
+    seen, first = np.unique(group[inside], return_index=True)
+    recorded[seen] = weights[inside[first]]
+
+    recent = np.flatnonzero(timestamps >= now - forecast_window.total_seconds())
+    t = (timestamps[recent] - now) / 86400
+    intercept, slope = _fit_trends(group[recent], t, weights[recent], len(users))
+    predicted = intercept + slope * (end - now) / 86400
+    enough = np.bincount(group[recent], minlength=len(users)) >= forecast_min_points
+
+    kind = np.where(~np.isnan(recorded), 'recorded', np.where(enough & ~np.isnan(target), 'forecast', 'unknown'))
+    value = np.where(kind == 'recorded', recorded, np.where(kind == 'forecast', predicted, np.nan))
+    passed = (kind != 'unknown') & (value < target)
+    return {
+        'user_id': user_ids, 'kind': kind, 'weight': value, 'target': target,
+        'passed': int(passed.sum()), 'failed': int(((kind != 'unknown') & ~passed).sum()), 'unknown': int((kind == 'unknown').sum()),
+    }
+
+
+def _forecast_digest(bot, group_id, ckpt, forecast):
+    failing = [i for i in np.argsort(-np.nan_to_num(forecast['weight'] - forecast['target'], nan=-np.inf), kind='stable')
+               if forecast['kind'][i] != 'unknown' and not forecast['weight'][i] < forecast['target'][i]]
+    text = f'检查点 {_ckpt_time_window(ckpt)} 即将开始，按最近 {forecast_window.days} 天的趋势预计通过 {forecast["passed"]} 人，' \
+           f'未通过 {forecast["failed"]} 人，数据不足 {forecast["unknown"]} 人'
+    if failing:
+        names = [_get_username(bot, group_id, forecast['user_id'][i]) for i in failing[:forecast_digest_limit]]
+        text += f'\n预计未通过：@{" @".join(names)}'
+        if len(failing) > forecast_digest_limit:
+            text += f' 等 {len(failing)} 人'
+    return text + '\n使用 /forecast 查看详情'
+
+
 def check_out_uid(update, context):
     group_id, user_id, username, message_id = _get_info(update)
     context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'gid={group_id} uid={user_id}')
@@ -1033,27 +2901,28 @@ def ckpt_overall_(update, context):
         return
     group_id, user_id, username, message_id = _get_info(update)
     ckpts, ckpt_path = _ensure_ckpt(update)
+    snapshot = _get_scale_snapshot(ckpt_path)
+    page_id = _get_page_id((group_id, 'ckpt_overall', snapshot['key'], _get_data_version(f'{ckpt_path}/ckpt.json')))
+    if _has_pages(page_id):
+        _send_page(context.bot, update.effective_chat.id, message_id, page_id)
+        return
 
     all_ckpt = []
     for ckpt_id, ckpt in ckpts['ckpt'].items():
-        if ckpt['status'] not in ['ended']:
+        if _ckpt_status(ckpt) != 'ended' or not _ckpt_calculated(ckpt):
             continue
-        end_time = float(ckpt['end'])
-        all_ckpt.append([ckpt, end_time])
+        all_ckpt.append([ckpt, ckpt.end])
     all_ckpt = sorted(all_ckpt, key=lambda x: x[1])
 
     history_min = {}
     achievement = {}
 
-    scale, scale_path = _ensure_scale(update)
-    for user_id in scale:
-        if not user_id.isdigit():
-            continue
-        if len(scale[user_id]["weight"]) > 0:
-            history_min[user_id] = float(scale[user_id]["weight"][0][1])
+    for user_id, challenger in snapshot['challengers'].items():
+        if len(challenger.series) > 0:
+            history_min[user_id] = float(challenger.series.weights[0])
 
     for ckpt, end_time in all_ckpt:
-        for user_id, scale in ckpt['result'].items():
+        for user_id, scale in ckpt.result_items():
             if user_id not in history_min:
                 if user_id in achievement:
                     achievement[user_id] += 1
@@ -1074,7 +2943,7 @@ def ckpt_overall_(update, context):
                 if user_id not in achievement:
                     achievement[user_id] = 0
 
-        for user_id, scale in ckpt['result'].items():
+        for user_id, scale in ckpt.result_items():
             if not scale:
                 continue
             if user_id not in history_min:
@@ -1091,83 +2960,601 @@ def ckpt_overall_(update, context):
     if len(output) == 0:
         context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='暂无数据')
         return
-    output_str = 'username    达标次数\n'
-    for i in output:
-        output_str += f'{i[0]}   {i[1]}\n'
-    context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=output_str)
-
+    _set_pages(page_id, 'username    达标次数\n', [f'{i[0]}   {i[1]}\n' for i in output])
+    _send_page(context.bot, update.effective_chat.id, message_id, page_id)
 
-def _calc_ckpt_result(context):
-    job_dict = context.job.context
-    ckpt_path = job_dict['args']['ckpt_path']
-    scale_path = job_dict['args']['scale_path']
-    info = job_dict['args']['info']
-    chat_id = job_dict['args']['chat_id']
-    ckpt_n = job_dict['args']['ckpt_num']
 
-    group_id, user_id, username, message_id = info
-    ckpt = _get_ckpt(ckpt_path)
-    ckpt_n = str(ckpt_n)
-    if ckpt['ckpt'][ckpt_n]['status'] not in ['pending', 'running', 'ended']:
+def dashboard(update, context):
+    context.bot.send_chat_action(chat_id=update.message.chat_id, action=telegram.ChatAction.UPLOAD_PHOTO)
+    group_id, user_id, username, message_id = _get_info(update)
+    try:
+        dashboard_(update, context)
+    except:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='好像遇到了 bug，请联系 @sqyon')
+        logging.exception(f"ERROR gid={group_id} uid={user_id}")
         return
-    scale = _get_scale(scale_path)
-    start_timestamp = ckpt['ckpt'][ckpt_n]['start']
-    end_timestamp = ckpt['ckpt'][ckpt_n]['end']
-    start_time = datetime.fromtimestamp(float(start_timestamp))
-    end_time = datetime.fromtimestamp(float(end_timestamp))
-    time_window = f"{_get_timestr(start_time.timestamp(), format='%Y-%m-%d-%H')} {_get_timestr(end_time.timestamp(), format='%Y-%m-%d-%H')}"
-    miss_user = []
-    for user_id, scale_data in scale.items():
-        if not user_id.isdigit():
+
+
+def _dashboard_stats(snapshot, ckpts):
+    users = snapshot['users']
+    valid = ~np.isnan(users['height']) & (users['count'] > 0)
+    if not valid.any():
+        return None
+    user_ids = [str(i) for i in users['user_id'][valid]]
+    heights = users['height'][valid]
+    lengths = users['count'][valid].astype(np.int64)
+    # records are laid out user after user, so a per-user mask expands to a per-record one
+    keep = np.repeat(valid, users['count'].astype(np.int64))
+    timestamps = snapshot['records']['timestamp'][keep]
+    weights = snapshot['records']['weight'][keep]
+
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    owner = np.repeat(np.arange(len(user_ids)), lengths)
+    first = weights[starts]
+    last = weights[ends - 1]
+
+    strategy_id = snapshot['strategy']
+    scores = vector_metrics[strategy_id](first, last, heights)
+    order = np.argsort(-scores, kind='stable')
+
+    bmi = last / heights ** 2
+    bmi_count, _ = np.histogram(bmi, bins=bmi_bins)
+
+    utc_offset = time.localtime().tm_gmtoff
+    days = np.floor((timestamps + utc_offset) / 86400).astype(np.int64)
+    day_min = days.min()
+    day_index = days - day_min
+    day_cnt = np.bincount(day_index)
+    day_sum = np.bincount(day_index, weights=weights - first[owner])
+    has_data = day_cnt > 0
+    trajectory_days = (np.nonzero(has_data)[0] + day_min) * 86400 - utc_offset
+    trajectory = day_sum[has_data] / day_cnt[has_data]
+
+    user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+    history_min = first.copy()
+    ckpt_names = []
+    pass_rates = []
+    ended = [ckpt for ckpt in ckpts.get('ckpt', {}).values() if _ckpt_status(ckpt) == 'ended' and _ckpt_calculated(ckpt)]
+    for ckpt in sorted(ended, key=lambda x: x.end):
+        result = np.full(len(user_ids), np.nan)
+        joined = np.zeros(len(user_ids), dtype=bool)
+        for user_id, record in ckpt.result_items():
+            if user_id not in user_index:
+                continue
+            joined[user_index[user_id]] = True
+            if record:
+                result[user_index[user_id]] = float(record[1])
+        if not joined.any():
             continue
-        for each_data in scale_data['weight']:
-            timestamp, weight = each_data
-            scale_time = datetime.fromtimestamp(float(timestamp))
+        passed = joined & (result < history_min)
+        ckpt_names.append(_get_timestr(ckpt.end, '%m-%d'))
+        pass_rates.append(passed.sum() / joined.sum())
+        history_min = np.fmin(history_min, result)
+
+    return {
+        'user_ids': user_ids,
+        'order': order,
+        'scores': scores,
+        'change': first - last,
+        'strategy': strategy_id,
+        'bmi_count': bmi_count,
+        'trajectory_days': trajectory_days,
+        'trajectory': trajectory,
+        'ckpt_names': ckpt_names,
+        'pass_rates': pass_rates,
+    }
 
-            if start_time < scale_time < end_time:
-                ckpt['ckpt'][ckpt_n]['result'][user_id] = each_data
-                break
-        if user_id not in ckpt['ckpt'][ckpt_n]['result']:
-            ckpt['ckpt'][ckpt_n]['result'][user_id] = None
-            username = _get_username(context.bot, group_id, user_id)
-            miss_user.append(username)
-    ckpt['ckpt'][ckpt_n]['status'] = 'ended'
-    json.dump(ckpt, open(f'{ckpt_path}/ckpt.json', "w"))
+
+def _render_dashboard(bot, group_id, stats, path, top=10):
+    leaders = stats['order'][:top][::-1]
+    names = [f'@{_get_username(bot, group_id, stats["user_ids"][i])}' for i in leaders]
+    with plot_lock:
+        _render_dashboard_figure(stats, leaders, names, path)
+
+
+def _render_dashboard_figure(stats, leaders, names, path):
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(2, 2, figsize=(12, 9))
+
+    axes[0][0].barh(names, stats['scores'][leaders])
+    for y, i in enumerate(leaders):
+        axes[0][0].annotate(f'{stats["change"][i]:.2f}', xy=(stats['scores'][i], y), va='center')
+    axes[0][0].set_title(f'leaderboard (strategy {stats["strategy"]})')
+    axes[0][0].set_xlabel('score')
+
+    if stats['ckpt_names']:
+        axes[0][1].bar(range(len(stats['ckpt_names'])), np.array(stats['pass_rates']) * 100, tick_label=stats['ckpt_names'])
+    axes[0][1].set_ylim(0, 100)
+    axes[0][1].set_title('checkpoint pass rate')
+    axes[0][1].set_ylabel('%')
+
+    axes[1][0].bar(bmi_labels, stats['bmi_count'])
+    axes[1][0].set_title('BMI distribution')
+    axes[1][0].set_ylabel('challengers')
+
+    trajectory_time = [datetime.fromtimestamp(i) for i in stats['trajectory_days']]
+    axes[1][1].plot(trajectory_time, stats['trajectory'], marker='o')
+    axes[1][1].xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
+    axes[1][1].set_title('group mean weight change')
+    axes[1][1].set_xlabel('time')
+    axes[1][1].set_ylabel('weight')
+
+    fig.tight_layout()
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+
+
+def dashboard_(update, context):
+    if not _running_challenge_only(update, context):
+        return
+    group_id, user_id, username, message_id = _get_info(update)
+    challenge, challenge_cnt = _get_latest_challenge(update)
+    challenge_path = f'./data/{group_id}/{challenge_cnt}'
+    snapshot = _get_scale_snapshot(challenge_path)
+    if snapshot['strategy'] is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text=f'请先使用 /strategy 指定比赛策略。')
+        return
+    version = (snapshot['key'], _get_data_version(f'{challenge_path}/ckpt.json'))
+    cache_key = (group_id, challenge_cnt)
+    cached = dashboard_cache.get(cache_key)
+    if cached is None or cached['version'] != version or not os.path.exists(cached['path']):
+        ckpts = _get_ckpt(challenge_path)
+        stats = _dashboard_stats(snapshot, ckpts)
+        if stats is None:
+            context.bot.send_message(chat_id=update.effective_chat.id, reply_to_message_id=message_id, text='暂无数据')
+            return
+        _ensure_path(f'./pic')
+        path = f'./pic/dashboard_{group_id}.png'
+        _render_dashboard(context.bot, group_id, stats, path)
+        dashboard_cache[cache_key] = {'version': version, 'path': path}
+    context.bot.send_photo(chat_id=update.effective_chat.id, reply_to_message_id=message_id, photo=open(dashboard_cache[cache_key]['path'], 'rb'))
+
+
+def _ckpt_status(ckpt, now=None):
+    if ckpt.status == 'deleted':
+        return 'deleted'
+    if now is None:
+        now = clock.timestamp()
+    if now < ckpt.start:
+        return 'pending'
+    if now < ckpt.end:
+        return 'running'
+    return 'ended'
+
+
+def _ckpt_calculated(ckpt):
+    # files written before the lifecycle engine only marked a checkpoint 'ended' once its result was in
+    return ckpt.status == 'ended' if ckpt.calculated is None else ckpt.calculated
+
+
+def _ckpt_time_window(ckpt):
+    return f"{_get_timestr(ckpt.start, format='%Y-%m-%d-%H')} {_get_timestr(ckpt.end, format='%Y-%m-%d-%H')}"
+
+
+def _ckpt_done_text(ckpt, miss_user):
     if len(miss_user):
-        context.bot.send_message(chat_id=chat_id, text=f'检查点 {time_window} 已统计完成，其中 @{" @".join(miss_user)} 缺失数据')
-    else:
-        context.bot.send_message(chat_id=chat_id, text=f'检查点 {time_window} 已统计完成，所有人数据完整')
+        return f'检查点 {_ckpt_time_window(ckpt)} 已统计完成，其中 @{" @".join(miss_user)} 缺失数据'
+    return f'检查点 {_ckpt_time_window(ckpt)} 已统计完成，所有人数据完整'
 
 
-def _print_alarm(context):
-    job_dict = context.job.context
-    ckpt_path = job_dict['args']['ckpt_path']
-    ckpt_n = str(job_dict['args']['ckpt_num'])
-    chat_id = job_dict['args']['chat_id']
-    text = job_dict['args']['text']
+def _calc_ckpt(bot, group_id, ckpt, snapshot):
+    readings = {}
+    for user_id, challenger in snapshot['challengers'].items():
+        i = challenger.series.first_between(ckpt.start, ckpt.end)
+        readings[user_id] = None if i is None else challenger.series.records[i].tolist()
+    missing = ckpt.set_results(readings)
+    ckpt.calculated = True
+    return [_get_username(bot, group_id, user_id) for user_id in missing]
 
-    ckpt = _get_ckpt(ckpt_path)
-    if ckpt['ckpt'][ckpt_n]['status'] not in ['pending', 'running', 'ended']:
-        return
-    st = ckpt['ckpt'][ckpt_n]['start']
-    st = datetime.fromtimestamp(float(st))
-    ed = ckpt['ckpt'][ckpt_n]['end']
-    ed = datetime.fromtimestamp(float(ed))
-    now = datetime.now()
-    if now < st:
-        ckpt['ckpt'][ckpt_n]['status'] = 'pending'
-    elif st <= now < ed:
-        ckpt['ckpt'][ckpt_n]['status'] = 'running'
-    else:
-        ckpt['ckpt'][ckpt_n]['status'] = 'ended'
-    json.dump(ckpt, open(f'{ckpt_path}/ckpt.json', 'w'))
-    context.bot.send_message(chat_id=chat_id, text=text)
+
+def _push_ckpt_events(group_id, ckpt_path, ckpt_n, ckpt, announce=False):
+    if ckpt.status == 'deleted' or _ckpt_calculated(ckpt):
+        return
+    now = clock.timestamp()
+    start = ckpt.start
+    events = []
+    if start > now:
+        if start - ckpt_forecast_ahead.total_seconds() > now:
+            events.append((start - ckpt_forecast_ahead.total_seconds(), 'forecast'))
+        if start - ckpt_alarm_ahead.total_seconds() > now:
+            events.append((start - ckpt_alarm_ahead.total_seconds(), 'alarm'))
+        elif announce:
+            events.append((now, 'alarm'))
+        events.append((start, 'alarm'))
+    events.append((max(ckpt.end, now), 'result'))
+    with ckpt_lock:
+        heap = ckpt_heaps.setdefault(group_id, [])
+        for due, kind in events:
+            heapq.heappush(heap, _CkptEvent(due, kind, ckpt_path, ckpt_n))
+        # stale entries are fine here, a group that has nothing due is skipped when popped
+        heapq.heappush(ckpt_due_heap, (heap[0].due, group_id))
+
+
+def _schedule_ckpt_engine(job_queue):
+    with ckpt_lock:
+        while ckpt_due_heap and not ckpt_heaps.get(ckpt_due_heap[0][1]):
+            heapq.heappop(ckpt_due_heap)
+        timer = ckpt_timer.get('job')
+        if not ckpt_due_heap:
+            if timer is not None:
+                timer[0].schedule_removal()
+                del ckpt_timer['job']
+            return
+        due = ckpt_due_heap[0][0]
+        if timer is not None:
+            if timer[1] <= due:
+                return
+            timer[0].schedule_removal()
+        delay = max(due - clock.timestamp(), 0)
+        ckpt_timer['job'] = (job_queue.run_once(_ckpt_tick, delay), due)
+    _log_sampled(f'ckpt engine due={_get_timestr(due)} groups={len(ckpt_heaps)}')
+
+
+def _ckpt_tick(context):
+    now = clock.timestamp()
+    due_groups = {}
+    with ckpt_lock:
+        ckpt_timer.pop('job', None)
+        while ckpt_due_heap and ckpt_due_heap[0][0] <= now + ckpt_tick_slack:
+            _, group_id = heapq.heappop(ckpt_due_heap)
+            heap = ckpt_heaps.get(group_id, [])
+            while heap and heap[0].due <= now + ckpt_tick_slack:
+                due_groups.setdefault(group_id, []).append(heapq.heappop(heap))
+            if heap:
+                heapq.heappush(ckpt_due_heap, (heap[0].due, group_id))
+            else:
+                ckpt_heaps.pop(group_id, None)
+    ckpt_metrics['ticks'] += 1
+    ckpt_metrics['groups'] += len(due_groups)
+    ckpt_metrics['events'] += sum(len(i) for i in due_groups.values())
+    for group_id, events in due_groups.items():
+        ckpt_pool.submit(_run_ckpt_events, context.bot, group_id, events)
+    _schedule_ckpt_engine(context.job_queue)
 
 
-job_funcs = {
-    'print_alarm': _print_alarm,
-    'calc_ckpt_result': _calc_ckpt_result
-}
+def _run_ckpt_events(bot, group_id, events):
+    _set_log_context(group_id, 'ckpt_event')
+    try:
+        with _get_ckpt_settle_lock(group_id):
+            messages = _settle_ckpt_events(bot, group_id, events)
+        for due, text in messages:
+            _announce(bot, int(group_id), text, due)
+    except:
+        logging.exception(f"ERROR ckpt events gid={group_id}")
+    finally:
+        _set_log_context()
+
+
+def _get_ckpt_settle_lock(group_id):
+    # held while ckpt.json of the group is read, settled and written, by the engine and by commands alike
+    with ckpt_lock:
+        return ckpt_settle_locks.setdefault(group_id, threading.Lock())
+
+
+def _settle_ckpt_events(bot, group_id, events):
+    ckpts = {}
+    scales = {}
+    changed = set()
+    messages = []
+    for event in events:
+        ckpt_path = event.ckpt_path
+        if ckpt_path not in ckpts:
+            ckpts[ckpt_path] = _get_ckpt(ckpt_path)
+        ckpt = ckpts[ckpt_path]['ckpt'].get(event.ckpt_n)
+        if ckpt is None or ckpt.status == 'deleted' or _ckpt_calculated(ckpt):
+            continue
+        if event.kind == 'alarm':
+            messages.append((event.due, f'请大家准备好参加 checkpoint 数据统计，时间窗口为 {_ckpt_time_window(ckpt)}'))
+        elif event.kind == 'forecast':
+            forecast = _forecast_ckpt(_get_scale_snapshot(ckpt_path), ckpts[ckpt_path], event.ckpt_n)
+            messages.append((event.due, _forecast_digest(bot, group_id, ckpt, forecast)))
+        else:
+            if ckpt_path not in scales:
+                scales[ckpt_path] = _get_scale_snapshot(ckpt_path)
+            miss_user = _calc_ckpt(bot, group_id, ckpt, scales[ckpt_path])
+            changed.add(ckpt_path)
+            messages.append((event.due, _ckpt_done_text(ckpt, miss_user)))
+    for ckpt_path in changed:
+        _dump_ckpt(ckpts[ckpt_path], ckpt_path)
+    return messages
+
+
+def _announce(bot, chat_id, text, due):
+    if 'thread' not in announce_worker:
+        announce_worker['thread'] = threading.Thread(target=_announce_loop, args=(bot,), name='announce', daemon=True)
+        announce_worker['thread'].start()
+    announce_queue.put((due, chat_id, text))
+
+
+def _announce_loop(bot):
+    last_sent = 0.0
+    chat_sent = {}
+    while True:
+        item = announce_queue.get()
+        if item is None:
+            announce_queue.task_done()
+            return
+        due, chat_id, text = item
+        # spread announcements that became due on the same hour instead of hitting the flood limit at :00
+        wait = max(last_sent + 1 / announce_rate, chat_sent.get(chat_id, 0.0) + announce_chat_gap) - time.monotonic()
+        time.sleep(max(wait, 0) + random.uniform(0, announce_jitter / max(announce_queue.qsize(), 1)))
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+        except:
+            logging.exception(f"ERROR announce gid={chat_id}")
+        last_sent = chat_sent[chat_id] = time.monotonic()
+        lag = clock.timestamp() - due
+        ckpt_metrics['sent'] += 1
+        ckpt_metrics['lag_last'] = lag
+        ckpt_metrics['lag_max'] = max(ckpt_metrics['lag_max'], lag)
+        _log_sampled(f'announce gid={chat_id} lag={lag:.2f}s queued={announce_queue.qsize()} metrics={ckpt_metrics}')
+        announce_queue.task_done()
+
+
+def _row_median(window):
+    # np.nanmedian without its per-row overhead, NaN sorts to the end of each row
+    ordered = np.sort(window, axis=1)
+    count = np.count_nonzero(~np.isnan(ordered), axis=1)
+    rows = np.arange(len(window))
+    return (ordered[rows, np.maximum(count - 1, 0) // 2] + ordered[rows, count // 2]) / 2
+
+
+def _find_anomalies(weights, starts, ends):
+    # rolling median/MAD over up to anomaly_window readings on each side, never crossing into another series
+    flagged = np.zeros(len(weights), dtype=bool)
+    medians = np.full(len(weights), np.nan)
+    offsets = np.arange(-anomaly_window, anomaly_window + 1)
+    for begin in range(0, len(weights), anomaly_chunk):
+        rows = np.arange(begin, min(begin + anomaly_chunk, len(weights)))
+        index = rows[:, None] + offsets
+        valid = (index >= starts[rows, None]) & (index < ends[rows, None])
+        window = np.where(valid, weights[np.clip(index, 0, len(weights) - 1)], np.nan)
+        median = _row_median(window)
+        mad = _row_median(np.abs(window - median[:, None]))
+        score = np.abs(weights[rows] - median) / np.maximum(1.4826 * mad, anomaly_min_mad)
+        # too few neighbours to say what is normal for this series
+        flagged[rows] = (valid.sum(axis=1) > anomaly_window) & (score > anomaly_threshold)
+        medians[rows] = median
+    return flagged, medians
+
+
+def _anomaly_scan(context):
+    start_time = time.perf_counter()
+    groups = []
+    for group_id, registry in _iter_group_registry():
+        scale_path = f'./data/{group_id}/{registry["challenge_cnt"]}'
+        if registry['status'] == 'ended' or not os.path.exists(f'{scale_path}/scale.json'):
+            continue
+        snapshot = _get_scale_snapshot(scale_path)
+        if len(snapshot['records']):
+            groups.append((group_id, snapshot))
+    if not groups:
+        return
+
+    sizes = [len(snapshot['records']) for _, snapshot in groups]
+    bases = np.cumsum([0] + sizes[:-1])
+    records = np.concatenate([snapshot['records'] for _, snapshot in groups])
+    tables = [snapshot['users'] for _, snapshot in groups]
+    counts = [users['count'].astype(np.int64) for users in tables]
+    starts = np.concatenate([np.repeat(base + users['offset'].astype(np.int64), count) for base, users, count in zip(bases, tables, counts)])
+    ends = starts + np.concatenate([np.repeat(count, count) for count in counts])
+    user_ids = np.concatenate([np.repeat(users['user_id'], count) for users, count in zip(tables, counts)])
+    group_index = np.repeat(np.arange(len(groups)), sizes)
+
+    flagged, medians = _find_anomalies(records['weight'], starts, ends)
+    flagged &= records['timestamp'] > (clock.now() - anomaly_lookback).timestamp()
+    hits = np.flatnonzero(flagged)
+    logging.info(f'anomaly scan groups={len(groups)} records={len(records)} flagged={len(hits)} took={time.perf_counter() - start_time:.2f}s')
+
+    digests = {}
+    for i in hits:
+        digests.setdefault(groups[group_index[i]][0], []).append((str(user_ids[i]), records['timestamp'][i], records['weight'][i], medians[i]))
+    for group_id, group_hits in digests.items():
+        ckpt_pool.submit(_send_anomaly_digest, context.bot, group_id, group_hits)
+
+
+def _send_anomaly_digest(bot, group_id, hits):
+    try:
+        lines = [f'@{_get_username(bot, group_id, user_id)} {_get_timestr(timestamp, format="%m-%d %H:%M")} 记录了 {weight:.2f} 千克，前后记录的中位数是 {median:.2f} 千克'
+                 for user_id, timestamp, weight, median in hits[:anomaly_digest_limit]]
+        if len(hits) > anomaly_digest_limit:
+            lines.append(f'……共 {len(hits)} 条')
+        title = bot.get_chat(int(group_id)).title
+        text = f'{title} 最近一天有 {len(hits)} 条体重记录明显偏离本人的其他记录，可能是输错或单位不对，请核实：\n' + '\n'.join(lines)
+        delivered = False
+        for admin_id in _get_admin(bot, group_id):
+            try:
+                bot.send_message(chat_id=int(admin_id), text=text)
+                delivered = True
+            except telegram.error.TelegramError:
+                # only admins who have started a private chat with the bot can be reached
+                continue
+        if not delivered:
+            bot.send_message(chat_id=int(group_id), text=text)
+    except:
+        logging.exception(f"ERROR anomaly digest gid={group_id}")
+
+
+class _ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _api_cached(path, query, version, build):
+    # version is cheap to work out (file stats, snapshot keys), the body is only rebuilt when it moves
+    key = (path, query)
+    with http_api_lock:
+        cached = http_api_cache.get(key)
+        if cached is not None and cached[0] == version:
+            http_api_cache.move_to_end(key)
+            return cached[1], cached[2]
+    body = json.dumps(build(), ensure_ascii=False).encode()
+    etag = '"' + hashlib.sha1(repr((key, version)).encode()).hexdigest() + '"'
+    with http_api_lock:
+        http_api_cache[key] = (version, etag, body)
+        http_api_cache.move_to_end(key)
+        while len(http_api_cache) > http_api_cache_size:
+            http_api_cache.popitem(last=False)
+    return etag, body
+
+
+def _api_challenge_path(group_id, query):
+    registry = _get_group_registry(group_id)
+    if registry is None:
+        raise _ApiError(404, 'no challenge in this group')
+    challenge_cnt = query.get('challenge', str(registry['challenge_cnt']))
+    challenge_path = f'./data/{group_id}/{challenge_cnt}'
+    if not challenge_cnt.isdigit() or not os.path.exists(challenge_path):
+        raise _ApiError(404, 'no such challenge')
+    return challenge_path
+
+
+def _api_snapshot(challenge_path):
+    # the API only reads what the bot has published, a missing snapshot is written by the bot's own next read of it
+    if os.path.exists(f'{challenge_path}/scale.snap'):
+        return _map_scale_snapshot(challenge_path)
+    if os.path.exists(f'{challenge_path}/scale.json'):
+        raise _ApiError(503, 'leaderboard is not ready yet, try again later')
+    raise _ApiError(404, 'no weight data in this challenge')
+
+
+def _api_int(query, name, default=None):
+    try:
+        return int(query[name]) if name in query else default
+    except ValueError:
+        raise _ApiError(400, f'{name} must be an integer')
+
+
+def _api_challenges(bot, query, group_id):
+    registry = _get_group_registry(group_id)
+    if registry is None:
+        raise _ApiError(404, 'no challenge in this group')
+    challenge_path = f'./data/{group_id}/challenge.json'
+
+    def build():
+        challenge = _read_json(challenge_path) or {'group_id': group_id, 'challenges': {}}
+        return {'group_id': group_id, 'status': registry['status'], 'challenge_cnt': registry['challenge_cnt'], 'challenges': challenge['challenges']}
+
+    return (_get_data_version(f'./data/{group_id}/registry.json', challenge_path), registry['status']), build
+
+
+def _api_leaderboard(bot, query, group_id):
+    snapshot = _api_snapshot(_api_challenge_path(group_id, query))
+    strategy = query.get('strategy', snapshot['strategy'])
+    if strategy not in metrics:
+        raise _ApiError(400, 'strategy is not set for this challenge' if strategy is None else 'unknown strategy')
+    days = _api_int(query, 'days')
+    time_limit = datetime.min if days is None else _get_day_limit(days)
+
+    def build():
+        user_data, _ = _get_shared_rank(bot, group_id, snapshot, time_limit, strategy=strategy)
+        return {'group_id': group_id, 'strategy': strategy, 'name': metrics[strategy]['name'], 'expression': metrics[strategy]['expression'],
+                'days': days, 'users': [{'rank': i + 1, 'user_id': user['user_id'], 'username': user['username'], 'fullname': user['fullname'],
+                                         'start_weight': float(user['weight'][0][1]), 'weight': float(user['weight'][-1][1]),
+                                         'score': float(user['score'])} for i, user in enumerate(user_data)]}
+
+    return (snapshot['key'], time_limit), build
+
+
+def _api_series(bot, query, group_id, user_id):
+    snapshot = _api_snapshot(_api_challenge_path(group_id, query))
+    if user_id not in snapshot['challengers']:
+        raise _ApiError(404, 'no such challenger')
+    days = _api_int(query, 'days')
+    since = _api_int(query, 'since', -np.inf if days is None else _get_day_limit(days).timestamp())
+    until = _api_int(query, 'until', np.inf)
+
+    def build():
+        challenger = snapshot['challengers'][user_id]
+        records = challenger.series.records
+        window = records[np.searchsorted(records['timestamp'], since, side='left'):np.searchsorted(records['timestamp'], until, side='left')]
+        return {'group_id': group_id, 'user_id': user_id, 'username': _get_username(bot, group_id, user_id), 'height': challenger.height,
+                'series': [[float(timestamp), float(weight)] for timestamp, weight in window]}
+
+    return (snapshot['key'], since, until), build
+
+
+def _api_checkpoints(bot, query, group_id):
+    ckpt_path = _api_challenge_path(group_id, query)
+
+    def build():
+        ckpts = _ckpts_from_json(_read_json(f'{ckpt_path}/ckpt.json') or {}).get('ckpt', {})
+        return {'group_id': group_id, 'checkpoints': {ckpt_n: {'start': ckpt.start, 'end': ckpt.end, 'status': _ckpt_status(ckpt),
+                                                               'calculated': _ckpt_calculated(ckpt), 'result': dict(ckpt.result_items())}
+                                                      for ckpt_n, ckpt in ckpts.items()}}
+
+    # checkpoints start and end on the hour, so their derived status only moves when the hour does
+    return (_get_data_version(f'{ckpt_path}/ckpt.json'), int(clock.timestamp() // 3600)), build
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    bot = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    routes = [
+        (re.compile(r'/groups/(-?\d+)/challenges'), _api_challenges),
+        (re.compile(r'/groups/(-?\d+)/leaderboard'), _api_leaderboard),
+        (re.compile(r'/groups/(-?\d+)/users/(\d+)/series'), _api_series),
+        (re.compile(r'/groups/(-?\d+)/checkpoints'), _api_checkpoints),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if status != 304:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        _set_log_context(None, 'http_api')
+        try:
+            for pattern, route in self.routes:
+                found = pattern.fullmatch(url.path)
+                if found is not None:
+                    break
+            else:
+                raise _ApiError(404, 'not found')
+            _set_log_context(found.group(1), 'http_api')
+            version, build = route(self.bot, query, *found.groups())
+            etag, body = _api_cached(url.path, tuple(sorted(query.items())), version, build)
+            if etag in [re.sub(r'^W/', '', i.strip()) for i in self.headers.get('If-None-Match', '').split(',')]:
+                self._reply(304, etag=etag)
+            else:
+                self._reply(200, body, etag)
+        except _ApiError as e:
+            self._reply(e.status, json.dumps({'error': str(e)}).encode())
+        except:
+            logging.exception(f"ERROR http api path={self.path}")
+            self._reply(500, json.dumps({'error': 'internal error'}).encode())
+        finally:
+            _set_log_context()
+
+
+def _start_http_api(bot):
+    host, _, port = http_api_address.rpartition(':')
+
+    class Handler(_ApiHandler):
+        pass
+
+    Handler.bot = bot
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='http-api', daemon=True).start()
+    logging.info(f'http api listening on {server.server_address}')
+    return server
 
 
 def done_job(job_dict):
@@ -1175,92 +3562,231 @@ def done_job(job_dict):
     running_jobs, running_job_path = _get_running_jobs()
     if str(job_id) in running_jobs:
         del running_jobs[str(job_id)]
-        json.dump(running_jobs, open(running_job_path, 'w'))
-    if job_id in queueing_job:
-        del queueing_job[job_id]
+        _dump_json(running_jobs, running_job_path)
     done_jobs, done_jobs_path = _get_done_jobs()
     done_jobs[job_id] = job_dict
-    json.dump(done_jobs, open(done_jobs_path, 'w'))
+    _dump_json(done_jobs, done_jobs_path)
 
 
-def start_job(job_dict, job_queue):
-    job_id = job_dict['id']
+def maintain_job(job_queue, warm=None):
+    # per-checkpoint jobs from running.json are superseded by the events rebuilt from ckpt.json below
     running_jobs, running_job_path = _get_running_jobs()
-    if job_id not in running_jobs:
-        running_jobs[job_id] = job_dict
-        json.dump(running_jobs, open(running_job_path, 'w'))
-    queueing_job[job_id] = job_dict
-    now = datetime.now()
-    run_time = datetime.fromtimestamp(job_dict['timestamp'])
-    if run_time >= now:
-        logging.info('start_job')
-        logging.info(json.dumps(job_dict, indent=4, ensure_ascii=False))
-        job_queue.run_once(base_job, run_time - now, context=job_dict)
-    else:
-        job_queue.run_once(base_job, timedelta(seconds=1), context=job_dict)
-        job_dict['done_status'] = {'done': 'passed', 'timestamp': now.timestamp()}
+    for job_id, job_dict in list(running_jobs.items()):
+        job_dict['done_status'] = {'done': 'migrated', 'timestamp': clock.timestamp()}
         done_job(job_dict)
 
+    restored = 0
+    for group_id, group_challenge in _iter_group_registry():
+        ckpt_path = f'./data/{group_id}/{group_challenge["challenge_cnt"]}'
+        saved = (warm or {}).get('ckpt', {}).get(group_id)
+        if saved is not None and saved['path'] == ckpt_path and saved['version'] == _get_data_version(f'{ckpt_path}/ckpt.json')[0]:
+            # ckpt.json has not moved since the last run wrote down what was still pending, carry on from there
+            _restore_ckpt_events(group_id, saved['events'])
+            restored += 1
+            continue
+        if not os.path.exists(f'{ckpt_path}/ckpt.json'):
+            continue
+        ckpt = _get_ckpt(ckpt_path)
+        for ckpt_n, each_ckpt in ckpt.get('ckpt', {}).items():
+            _push_ckpt_events(group_id, ckpt_path, ckpt_n, each_ckpt)
+    if warm is not None:
+        logging.info(f'warm restart: ckpt events of {restored} groups restored, the rest rebuilt from ckpt.json')
+    _schedule_ckpt_engine(job_queue)
+
+
+def _restore_ckpt_events(group_id, events):
+    now = clock.timestamp()
+    # alarms and forecasts that came due while the bot was down collapse into the latest one per checkpoint,
+    # and are dropped when the checkpoint's result is due too, its announcement says it all
+    ended = {(ckpt_path, ckpt_n) for due, kind, ckpt_path, ckpt_n in events if kind == 'result' and due <= now}
+    alarmed = set()
+    with ckpt_lock:
+        heap = ckpt_heaps.setdefault(group_id, [])
+        for due, kind, ckpt_path, ckpt_n in sorted(events, reverse=True):
+            if kind != 'result' and due <= now:
+                if (ckpt_path, ckpt_n) in ended or (ckpt_path, ckpt_n, kind) in alarmed:
+                    continue
+                alarmed.add((ckpt_path, ckpt_n, kind))
+            heapq.heappush(heap, _CkptEvent(due, kind, ckpt_path, ckpt_n))
+        if heap:
+            heapq.heappush(ckpt_due_heap, (heap[0].due, group_id))
+        else:
+            del ckpt_heaps[group_id]
+
+
+def _save_warm_state():
+    # runs after the updater has stopped; the pools and timers that still change the caches below are drained first
+    ckpt_pool.shutdown(wait=True)
+    for lane in lanes.values():
+        lane['pool'].shutdown(wait=True)
+    precompute_stop.set()
+    with precompute_lock:
+        for pending in precompute_pending.values():
+            pending['timer'].cancel()
+        precompute_pending.clear()
+    # a refresh that had already started holds the run lock until it is done
+    with precompute_run_lock:
+        pass
+    with announce_queue.mutex:
+        announcements = list(announce_queue.queue)
+        announce_queue.queue.clear()
+    if 'thread' in announce_worker:
+        # let the announcement being sent right now finish, the rest is handed over
+        announce_queue.put(None)
+        announce_worker['thread'].join(timeout=announce_chat_gap + announce_jitter + http_read_timeout)
+
+    now = time.monotonic()
+    ckpt = {}
+    with ckpt_lock:
+        for group_id, entry in _iter_group_registry():
+            ckpt_path = f'./data/{group_id}/{entry["challenge_cnt"]}'
+            ckpt[group_id] = {'path': ckpt_path, 'version': _get_data_version(f'{ckpt_path}/ckpt.json')[0],
+                              'events': [(event.due, event.kind, event.ckpt_path, event.ckpt_n) for event in ckpt_heaps.get(group_id, [])]}
+    with page_lock:
+        pages = list(page_cache.items())
+    with http_api_lock:
+        api = list(http_api_cache.items())
+    state = {
+        'format': warm_state_format,
+        'saved': clock.timestamp(),
+        'ckpt': ckpt,
+        'announcements': announcements,
+        'registry': {group_id: (_get_data_version(f'./data/{group_id}/registry.json')[0], entry)
+                     for group_id, entry in challenge_registry.items() if entry is not None},
+        'members': [(key, (expire - now, user)) for key, (expire, user) in member_cache.items() if expire > now],
+        'pages': pages,
+        'plots': plot_cache,
+        'league_boards': league_boards,
+        'weight_aggs': weight_aggs,
+        'api': api,
+    }
+    data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    _ensure_path(job_path)
+    tmp_path = f'{warm_state_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(warm_state_magic + hashlib.sha256(data).digest() + data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, warm_state_path)
+    logging.info(f'warm state saved: {len(data)} bytes, {sum(len(i["events"]) for i in ckpt.values())} ckpt events, '
+                 f'{len(announcements)} announcements')
 
-def base_job(context):
-    job_dict = context.job.context
-
-    job_funcs[job_dict['func']](context)
-
-    job_dict['done_status'] = {'done': 'done', 'timestamp': datetime.now().timestamp()}
-    done_job(job_dict)
 
+def _load_warm_state():
+    try:
+        with open(warm_state_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # only ever restored once, a crash later on must not bring back state from before this run
+    os.remove(warm_state_path)
+    header = len(warm_state_magic) + hashlib.sha256().digest_size
+    if data[:len(warm_state_magic)] != warm_state_magic or hashlib.sha256(data[header:]).digest() != data[len(warm_state_magic):header]:
+        logging.warning(f'{warm_state_path} is damaged, starting cold')
+        return None
+    state = pickle.loads(data[header:])
+    if state.get('format') != warm_state_format:
+        logging.info(f'{warm_state_path} has format {state.get("format")}, starting cold')
+        return None
 
-def maintain_job(job_queue):
-    running_jobs, running_job_path = _get_running_jobs()
-    for job_id, job_dict in running_jobs.items():
-        if job_id not in queueing_job:
-            start_job(job_dict, job_queue)
+    # everything below is checked against the files again: registry entries here, snapshot keys and data versions on use
+    for group_id, (version, entry) in state['registry'].items():
+        if version is not None and version == _get_data_version(f'./data/{group_id}/registry.json')[0]:
+            challenge_registry[group_id] = entry
+    now = time.monotonic()
+    down = clock.timestamp() - state['saved']
+    for key, (left, user) in state['members']:
+        if left > down:
+            member_cache[key] = (now + left - down, user)
+    with page_lock:
+        page_cache.update(state['pages'])
+    plot_cache.update({key: value for key, value in state['plots'].items() if os.path.exists(value['path'])})
+    league_boards.update(state['league_boards'])
+    weight_aggs.update(state['weight_aggs'])
+    with http_api_lock:
+        http_api_cache.update(state['api'])
+    logging.info(f'warm state loaded: saved {down:.0f}s ago, {len(challenge_registry)} registries, {len(member_cache)} members, '
+                 f'{len(page_cache)} pages, {len(plot_cache)} plots')
+    return state
+
+
+def _add_handlers(dp):
+    _add_command(dp, 'start', start)
+    _add_command(dp, 'help', print_help)
+
+    _add_command(dp, 'new_challenge', new_challenge)
+    _add_command(dp, 'end_challenge', end_challenge)
+    _add_command(dp, 'join_challenge', join_challenge)
+    _add_command(dp, 'delete_user', delete_user)
+
+    _add_command(dp, 'w', weight)
+    _add_command(dp, 'weight', weight)
+    _add_command(dp, 'height', height)
+    _add_command(dp, 'me', me)
+    _add_command(dp, 'import', import_data)
+
+    _add_command(dp, 'strategy', strategy)
+    _add_command(dp, 'rank', rank)
+    _add_command(dp, 'week', week_rank)
+    _add_command(dp, 'overall', overall_rank)
+    _add_command(dp, 'league', league)
+
+    _add_command(dp, 'plot', plot)
+
+    _add_command(dp, 'ckpt_add', ckpt_add)
+    _add_command(dp, 'ckpt_del', ckpt_del)
+    _add_command(dp, 'ckpt_list', ckpt_list)
+    _add_command(dp, 'ckpt_result', ckpt_result)
+    _add_command(dp, 'ckpt_overall', ckpt_overall)
+    _add_command(dp, 'forecast', forecast)
+    _add_command(dp, 'dashboard', dashboard)
+
+    _add_command(dp, 'uid', check_out_uid)
+    _add_command(dp, 'profile', profile)
+    dp.add_handler(CallbackQueryHandler(_command('page', page_callback), pattern=r'^page:'))
 
 
 def main(bot_token):
-    updater = Updater(token=bot_token, use_context=True)
+    updater = Updater(bot=_make_bot(bot_token), workers=bot_workers, use_context=True)
     dp = updater.dispatcher
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO, filename="bot.log", filemode="a")
-    # logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    log_listener = _setup_logging()
 
     if not os.path.exists('./data'):
         os.makedirs('./data')
 
     job_queue = dp.job_queue
-    maintain_job(job_queue)
-
-    dp.add_handler(CommandHandler('start', start))
-    dp.add_handler(CommandHandler('help', print_help))
-
-    dp.add_handler(CommandHandler('new_challenge', new_challenge))
-    dp.add_handler(CommandHandler('end_challenge', end_challenge))
-    dp.add_handler(CommandHandler('join_challenge', join_challenge))
-    dp.add_handler(CommandHandler('delete_user', delete_user))
-
-    dp.add_handler(CommandHandler('w', weight))
-    dp.add_handler(CommandHandler('weight', weight))
-    dp.add_handler(CommandHandler('height', height))
-
-    dp.add_handler(CommandHandler('strategy', strategy))
-    dp.add_handler(CommandHandler('rank', rank))
-    dp.add_handler(CommandHandler('week', week_rank))
-    dp.add_handler(CommandHandler('overall', overall_rank))
-
-    dp.add_handler(CommandHandler('plot', plot))
-
-    dp.add_handler(CommandHandler('ckpt_add', ckpt_add))
-    dp.add_handler(CommandHandler('ckpt_del', ckpt_del))
-    dp.add_handler(CommandHandler('ckpt_list', ckpt_list))
-    dp.add_handler(CommandHandler('ckpt_result', ckpt_result))
-    dp.add_handler(CommandHandler('ckpt_overall', ckpt_overall))
-
-    dp.add_handler(CommandHandler('uid', check_out_uid))
-
+    warm = _load_warm_state()
+    maintain_job(job_queue, warm)
+    for due, chat_id, text in (warm or {}).get('announcements', []):
+        _announce(updater.bot, chat_id, text, due)
+    job_queue.run_repeating(_report_api_latency, api_latency_report_interval)
+    job_queue.run_daily(_anomaly_scan, anomaly_scan_time)
+    job_queue.run_repeating(_save_update_state, update_state_interval)
+
+    _add_handlers(dp)
+    if record_path:
+        dp.add_handler(TypeHandler(telegram.Update, _record_update), group=-1)
+    dp.add_handler(TypeHandler(telegram.Update, _track_update), group=1)
+
+    http_api = _start_http_api(updater.bot) if http_api_address else None
+    _catch_up(updater)
     updater.start_polling()
     updater.idle()
+    if http_api is not None:
+        http_api.shutdown()
+    _save_update_state()
+    _save_warm_state()
+    log_listener.stop()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        if len(sys.argv) != 5:
+            print('usage: python main.py import <group_id> <user_id> <csv file>')
+            sys.exit(2)
+        sys.exit(import_cli(*sys.argv[2:5]))
+    if len(sys.argv) != 2:
+        print('usage: python main.py <bot token>\n       python main.py import <group_id> <user_id> <csv file>')
+        sys.exit(2)
     token = sys.argv[1]
     main(bot_token=token)
@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import telegram
+from telegram.ext import Updater
+
+import main
+from stub_telegram import StubTelegram
+
+
+# Replays traffic recorded with SCALE_BOT_RECORD=<log> through the real handlers, against stub_telegram.py
+# and an anonymized copy of the data directory, then reports throughput, latency and API calls:
+#   python replay.py <log> <data dir> [speed, 1-100]
+# The data copy is hashed with <log>.salt, so the ids in it line up with the ones in the log.
+
+
+def anonymize_data(src, dst, salt):
+    def anon(value):
+        return str(main._anonymize_id(value, salt))
+
+    os.makedirs(dst)
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        if name == 'challenges.json':
+            main._dump_json({anon(group_id): entry for group_id, entry in main._load_json(path, {}).items()}, os.path.join(dst, name))
+        if not os.path.isdir(path) or not name.lstrip('-').isdigit():
+            continue
+        group_path = os.path.join(dst, anon(name))
+        os.makedirs(group_path)
+        if os.path.exists(os.path.join(path, 'registry.json')):
+            main._dump_json(main._load_json(os.path.join(path, 'registry.json'), {}), os.path.join(group_path, 'registry.json'))
+        if os.path.exists(os.path.join(path, 'challenge.json')):
+            challenge = main._load_json(os.path.join(path, 'challenge.json'), {})
+            challenge['group_id'] = anon(name)
+            for each in challenge.get('challenges', {}).values():
+                for key in ['start_user', 'end_user']:
+                    if each.get(key):
+                        each[key] = anon(each[key])
+                each['challengers'] = [anon(user_id) for user_id in each.get('challengers', [])]
+            main._dump_json(challenge, os.path.join(group_path, 'challenge.json'))
+        for challenge_cnt in os.listdir(path):
+            if not challenge_cnt.isdigit():
+                continue
+            os.makedirs(os.path.join(group_path, challenge_cnt))
+            scale_path = os.path.join(path, challenge_cnt, 'scale.json')
+            if os.path.exists(scale_path):
+                scale = main._load_json(scale_path, {})
+                main._dump_json({anon(key) if key.isdigit() else key: value for key, value in scale.items()},
+                                os.path.join(group_path, challenge_cnt, 'scale.json'))
+            ckpt_path = os.path.join(path, challenge_cnt, 'ckpt.json')
+            if os.path.exists(ckpt_path):
+                ckpt = main._load_json(ckpt_path, {})
+                for each in ckpt.get('ckpt', {}).values():
+                    each['result'] = {anon(user_id): record for user_id, record in each.get('result', {}).items()}
+                main._dump_json(ckpt, os.path.join(group_path, challenge_cnt, 'ckpt.json'))
+
+
+def make_update(bot, update_id, chat_id, chat_type, user_id, text):
+    sender = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+    chat = {'id': chat_id, 'type': chat_type, 'title': 'replay'}
+    data = {'update_id': update_id}
+    if text.startswith('callback:'):
+        data['callback_query'] = {'id': str(update_id), 'from': sender, 'chat_instance': str(chat_id), 'data': text[len('callback:'):],
+                                  'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': ''}}
+    else:
+        data['message'] = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': sender, 'text': text,
+                           'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}
+    return telegram.Update.de_json(data, bot)
+
+
+def percentiles(values):
+    values = np.array(values) * 1000
+    return f'{len(values):7d} {np.percentile(values, 50):8.1f} {np.percentile(values, 90):8.1f} {np.percentile(values, 99):8.1f} {values.max():8.1f}'
+
+
+def replay(log_path, data_path, speed):
+    with open(log_path, encoding='utf-8') as f:
+        records = sorted(json.loads(line) for line in f if line.strip())
+    salt = main._get_record_salt(log_path)
+    work_path = tempfile.mkdtemp(prefix='replay-')
+    anonymize_data(data_path, os.path.join(work_path, 'data'), salt)
+    os.chdir(work_path)
+
+    stub = StubTelegram(0).start()
+    stub.senders.update(user_id for _, _, _, user_id, _ in records)
+    main.api_base_url = stub.base_url
+    main.api_base_file_url = stub.base_file_url
+    main.precompute_enabled = False
+
+    # every handler reports back when it is done, measured from the moment its update was queued
+    lock = threading.Lock()
+    arrivals = {}
+    latencies = {}
+    command = main._command
+
+    def timed_command(name, func):
+        handler = command(name, func)
+
+        def wrapper(update, context):
+            try:
+                return handler(update, context)
+            finally:
+                with lock:
+                    latencies.setdefault(name, []).append(time.perf_counter() - arrivals[update.update_id])
+
+        return wrapper
+
+    main._command = timed_command
+    updater = Updater(bot=main._make_bot('123:replay'), workers=main.bot_workers, use_context=True)
+    main._add_handlers(updater.dispatcher)
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+
+    def handled(text):
+        return text.startswith('callback:page:') or text.split()[0].lstrip('/') in main.profile_commands
+
+    expected = sum(handled(text) for _, _, _, _, text in records)
+    start_time = time.perf_counter()
+    for update_id, (timestamp, chat_id, chat_type, user_id, text) in enumerate(records, 1):
+        delay = (timestamp - records[0][0]) / speed - (time.perf_counter() - start_time)
+        if delay > 0:
+            time.sleep(delay)
+        arrivals[update_id] = time.perf_counter()
+        updater.dispatcher.update_queue.put(make_update(updater.bot, update_id, chat_id, chat_type, user_id, text))
+    feed_time = time.perf_counter() - start_time
+
+    rejected = 0
+    deadline = time.perf_counter() + 300
+    while time.perf_counter() < deadline:
+        rejected = sum(lane['rejected'] for lane in main.lanes.values())
+        with lock:
+            done = sum(len(i) for i in latencies.values())
+        if done + rejected >= expected:
+            break
+        time.sleep(0.05)
+    total_time = time.perf_counter() - start_time
+    updater.dispatcher.stop()
+    stub.stop()
+    shutil.rmtree(work_path, ignore_errors=True)
+
+    print(f'replayed {len(records)} updates ({expected} handled) at {speed}x: fed in {feed_time:.1f}s, done in {total_time:.1f}s, '
+          f'{done / total_time:.1f} updates/s')
+    print(f'{"latency ms":16} {"count":>7} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}')
+    if latencies:
+        print(f'{"all":16} {percentiles([j for i in latencies.values() for j in i])}')
+    for name, values in sorted(latencies.items(), key=lambda x: -len(x[1])):
+        print(f'{name:16} {percentiles(values)}')
+    print('busy replies: ' + ', '.join(f'{name}={lane["rejected"]}' for name, lane in main.lanes.items()))
+    print('api calls: ' + ', '.join(f'{method}={count}' for method, count in sorted(stub.calls.items(), key=lambda x: -x[1])))
+    if done + rejected < expected:
+        print(f'{expected - done - rejected} updates were still unfinished after the timeout')
+
+
+if __name__ == '__main__':
+    replay(sys.argv[1], sys.argv[2], min(max(float(sys.argv[3]) if len(sys.argv) > 3 else 1.0, 1.0), 100.0))
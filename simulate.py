@@ -0,0 +1,247 @@
+import cProfile
+import heapq
+import io
+import itertools
+import math
+import os
+import pstats
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+import telegram
+
+import main
+
+
+# Runs whole challenges on a virtual clock through the real handlers and checkpoint engine:
+#   python simulate.py [groups] [users per group] [days] [--profile]
+# Every group weighs in daily, adds a checkpoint each week and asks for rankings, the checkpoint
+# alarms and results fire from the simulated job queue. Work happens in a temporary directory.
+
+
+class SimClock(main._Clock):
+    def __init__(self, start):
+        self.current = start
+
+    def now(self):
+        return self.current
+
+
+class SimJob:
+    def __init__(self, callback, due, interval=None, context=None):
+        self.callback = callback
+        self.due = due
+        self.interval = interval
+        self.context = context
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class SimJobQueue:
+    # the part of telegram.ext.JobQueue the bot uses, on virtual time
+    def __init__(self, clock, bot):
+        self.clock = clock
+        self.bot = bot
+        self.jobs = []
+        self.seq = itertools.count()
+        self.ran = 0
+
+    def _when(self, when):
+        if isinstance(when, datetime):
+            return when
+        if isinstance(when, timedelta):
+            return self.clock.now() + when
+        return self.clock.now() + timedelta(seconds=when)
+
+    def _push(self, job):
+        heapq.heappush(self.jobs, (job.due, next(self.seq), job))
+        return job
+
+    def run_once(self, callback, when, context=None, name=None):
+        return self._push(SimJob(callback, self._when(when), context=context))
+
+    def run_repeating(self, callback, interval, first=None, context=None, name=None):
+        interval = interval if isinstance(interval, timedelta) else timedelta(seconds=interval)
+        return self._push(SimJob(callback, self._when(first if first is not None else interval), interval, context))
+
+    def run_daily(self, callback, time, days=tuple(range(7)), context=None, name=None):
+        due = datetime.combine(self.clock.now().date(), time)
+        if due <= self.clock.now():
+            due += timedelta(days=1)
+        return self._push(SimJob(callback, due, timedelta(days=1), context))
+
+    def next_due(self):
+        while self.jobs and self.jobs[0][2].removed:
+            heapq.heappop(self.jobs)
+        return self.jobs[0][0] if self.jobs else None
+
+    def run_next(self):
+        _, _, job = heapq.heappop(self.jobs)
+        self.clock.current = max(self.clock.current, job.due)
+        if job.interval is not None:
+            job.due += job.interval
+            self._push(job)
+        self.ran += 1
+        job.callback(types.SimpleNamespace(bot=self.bot, job_queue=self, job=job))
+
+
+class SimBot:
+    def __init__(self):
+        self.calls = {}
+        self.message_id = 0
+
+    def _count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.message_id += 1
+        return types.SimpleNamespace(message_id=self.message_id)
+
+    def _user(self, user_id):
+        return telegram.User(int(user_id), f'user{user_id}', is_bot=False, username=f'user{user_id}')
+
+    def send_message(self, *args, **kwargs):
+        return self._count('send_message')
+
+    def send_photo(self, *args, **kwargs):
+        return self._count('send_photo')
+
+    def send_document(self, *args, **kwargs):
+        return self._count('send_document')
+
+    def send_chat_action(self, *args, **kwargs):
+        return self._count('send_chat_action')
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._count('edit_message_text')
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._count('answer_callback_query')
+
+    def get_chat(self, chat_id):
+        self._count('get_chat')
+        return types.SimpleNamespace(id=chat_id, title=f'group{chat_id}')
+
+    def get_chat_member(self, chat_id, user_id):
+        self._count('get_chat_member')
+        return telegram.ChatMember(self._user(user_id), 'member')
+
+    def get_chat_administrators(self, chat_id):
+        # the first member of every simulated group runs it
+        self._count('get_chat_administrators')
+        return [telegram.ChatMember(self._user(member_id(chat_id, 0)), 'administrator')]
+
+
+class InlineExecutor:
+    def submit(self, func, *args):
+        func(*args)
+
+
+def member_id(chat_id, i):
+    return -int(chat_id) * 1000 + i
+
+
+def make_update(bot, update_id, chat_id, user_id, text):
+    return telegram.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(main.clock.timestamp()), 'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'group{chat_id}'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}, 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}}, bot)
+
+
+def plan(groups, users, days, start):
+    actions = []
+    for g in range(groups):
+        chat_id = -(1000 + g)
+        admin = member_id(chat_id, 0)
+        at = start + timedelta(minutes=g)
+        actions.append((at, chat_id, admin, '/new_challenge'))
+        actions.append((at + timedelta(seconds=1), chat_id, admin, '/strategy 1'))
+        for u in range(users):
+            user_id = member_id(chat_id, u)
+            if u:
+                actions.append((at + timedelta(seconds=2), chat_id, user_id, '/join_challenge'))
+            actions.append((at + timedelta(seconds=3), chat_id, user_id, f'/height {random.uniform(1.55, 1.9):.2f}'))
+        weights = [random.uniform(60, 110) for _ in range(users)]
+        for day in range(days):
+            date = (start + timedelta(days=day)).replace(hour=0, minute=0, second=0)
+            for u in range(users):
+                weights[u] += random.uniform(-0.35, 0.25)
+                if random.random() < 0.9:
+                    actions.append((date + timedelta(hours=7, seconds=random.uniform(0, 3 * 3600)), chat_id, member_id(chat_id, u), f'/w {weights[u]:.1f}'))
+            if day % 7 == 0:
+                window = date + timedelta(days=6)
+                actions.append((date + timedelta(hours=12), chat_id, admin,
+                                f'/ckpt_add {window.year}-{window.month}-{window.day}-7 {window.year}-{window.month}-{window.day}-10'))
+            actions.append((date + timedelta(hours=20), chat_id, member_id(chat_id, random.randrange(users)), random.choice(['/week', '/overall', '/rank 3'])))
+        end = start + timedelta(days=days)
+        actions.append((end, chat_id, admin, '/ckpt_overall'))
+        actions.append((end + timedelta(seconds=1), chat_id, admin, '/end_challenge'))
+    actions.sort()
+    return actions
+
+
+def simulate(groups, users, days):
+    random.seed(0)
+    start = datetime(2024, 1, 1, 6)
+    work_path = tempfile.mkdtemp(prefix='simulate-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.chdir(work_path)
+    os.makedirs('./data')
+
+    main.clock = SimClock(start)
+    main.precompute_enabled = False
+    main.announce_rate = math.inf
+    main.announce_chat_gap = 0
+    main.announce_jitter = 0
+    main.ckpt_pool = InlineExecutor()
+    bot = SimBot()
+    job_queue = SimJobQueue(main.clock, bot)
+    main.maintain_job(job_queue)
+    job_queue.run_daily(main._anomaly_scan, main.anomaly_scan_time)
+
+    handlers = {'new_challenge': main.new_challenge, 'strategy': main.strategy, 'join_challenge': main.join_challenge, 'height': main.height,
+                'w': main.weight, 'ckpt_add': main.ckpt_add, 'week': main.week_rank, 'overall': main.overall_rank, 'rank': main.rank,
+                'ckpt_overall': main.ckpt_overall, 'end_challenge': main.end_challenge}
+    actions = plan(groups, users, days, start)
+    commands = {}
+    real_start = time.perf_counter()
+    for update_id, (at, chat_id, user_id, text) in enumerate(actions, 1):
+        while job_queue.next_due() is not None and job_queue.next_due() <= at:
+            job_queue.run_next()
+            main.announce_queue.join()
+        main.clock.current = max(main.clock.current, at)
+        command = text.split()[0][1:]
+        command_start = time.perf_counter()
+        handlers[command](make_update(bot, update_id, chat_id, user_id, text), types.SimpleNamespace(bot=bot, job_queue=job_queue))
+        commands.setdefault(command, []).append(time.perf_counter() - command_start)
+    real_time = time.perf_counter() - real_start
+
+    calculated = 0
+    for g in range(groups):
+        ckpts = main._get_ckpt(f'./data/{-(1000 + g)}/1').get('ckpt', {})
+        calculated += sum(main._ckpt_calculated(ckpt) for ckpt in ckpts.values())
+    span = main.clock.now() - start
+    print(f'{groups} groups x {users} users, {span.days} virtual days in {real_time:.1f}s ({span.total_seconds() / real_time:,.0f}x real time)')
+    print(f'{len(actions)} commands, {job_queue.ran} scheduled jobs, {calculated} checkpoints settled, engine {main.ckpt_metrics}')
+    print(f'{"command":16} {"count":>7} {"mean ms":>9} {"max ms":>9}')
+    for command, durations in sorted(commands.items(), key=lambda x: -sum(x[1])):
+        print(f'{command:16} {len(durations):7d} {sum(durations) / len(durations) * 1000:9.2f} {max(durations) * 1000:9.2f}')
+    print('bot calls: ' + ', '.join(f'{method}={count}' for method, count in sorted(bot.calls.items(), key=lambda x: -x[1])))
+    shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = [i for i in sys.argv[1:] if i != '--profile']
+    sizes = [int(i) for i in args] + [5, 10, 90][len(args):]
+    if '--profile' in sys.argv:
+        profiler = cProfile.Profile()
+        profiler.runcall(simulate, *sizes)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(30)
+        print(output.getvalue())
+    else:
+        simulate(*sizes)
@@ -0,0 +1,168 @@
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A tiny stand-in for the Telegram Bot API, enough for main.py to run against it:
+#   python stub_telegram.py 8081 [latency seconds]
+#   SCALE_BOT_API_URL=http://127.0.0.1:8081/bot SCALE_BOT_API_FILE_URL=http://127.0.0.1:8081/file/bot python main.py <any token>
+# Updates are fed with POST /_stub/updates (a JSON update or a list of them), call counts are at GET /_stub/stats.
+
+
+class StubTelegram:
+    def __init__(self, port=8081, latency=0.0, admins=None):
+        self.port = port
+        self.latency = latency
+        self.admins = admins
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.updates = []
+        self.files = {}
+        self.senders = set()
+        self.message_id = 0
+        self.server = None
+
+    def start(self):
+        stub = self
+
+        class Handler(_StubHandler):
+            pass
+
+        Handler.stub = stub
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='stub-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}/bot'
+
+    @property
+    def base_file_url(self):
+        return f'http://127.0.0.1:{self.port}/file/bot'
+
+    def push_update(self, update):
+        with self.lock:
+            self.updates.append(update)
+            sender = update.get('message', {}).get('from')
+            if sender is not None:
+                self.senders.add(sender['id'])
+
+    def add_file(self, file_id, content):
+        self.files[file_id] = content
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+    def user(self, user_id):
+        return {'id': int(user_id), 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+    def call(self, method, params):
+        self.count(method)
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            deadline = time.monotonic() + min(float(params.get('timeout') or 0), 1.0)
+            while True:
+                with self.lock:
+                    self.updates = [i for i in self.updates if i['update_id'] >= offset]
+                    pending = self.updates[:int(params.get('limit') or 100)]
+                if pending or time.monotonic() >= deadline:
+                    return pending
+                time.sleep(0.05)
+        if method in ['sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText']:
+            chat_id = int(params.get('chat_id') or 0)
+            return {'message_id': self.next_message_id(), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'stub'}, 'text': params.get('text', '')}
+        if method == 'getChatMember':
+            return {'user': self.user(params['user_id']), 'status': 'member'}
+        if method == 'getChatAdministrators':
+            admins = self.admins if self.admins is not None else sorted(self.senders)
+            return [{'user': self.user(i), 'status': 'administrator'} for i in admins]
+        if method == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_path': f'stub/{params["file_id"]}'}
+        return True
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in two writes, Nagle would hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body or b'{}')
+        # multipart uploads: only the plain form fields are of interest here
+        params = {}
+        for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+            params[name.decode()] = value.decode(errors='replace')
+        return params
+
+    def do_GET(self):
+        if self.path == '/_stub/stats':
+            self._reply(200, self.stub.calls)
+            return
+        found = re.match(r'/file/bot[^/]+/stub/(.+)', self.path)
+        if found and found.group(1) in self.stub.files:
+            self.stub.count('download')
+            self._reply(200, self.stub.files[found.group(1)], 'application/octet-stream')
+            return
+        self._reply(404, {'ok': False, 'description': 'Not Found'})
+
+    def do_POST(self):
+        params = self._read_params()
+        if self.path == '/_stub/updates':
+            for update in params if isinstance(params, list) else [params]:
+                self.stub.push_update(update)
+            self._reply(200, {'ok': True})
+            return
+        found = re.match(r'/bot[^/]+/(\w+)', self.path)
+        if found is None:
+            self._reply(404, {'ok': False, 'description': 'Not Found'})
+            return
+        self._reply(200, {'ok': True, 'result': self.stub.call(found.group(1), params)})
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    stub = StubTelegram(port, latency).start()
+    print(f'stub Telegram API on {stub.base_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()